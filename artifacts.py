@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+
+from loguru import logger
+
+from incremental import file_hash
+from sync import fast_copy
+
+
+def parse_shard(text):
+    """`i/N` -> (i, N), shards being numbered from 0."""
+    try:
+        index, count = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise ValueError(f"Expected a shard like 0/4, got {text!r}")
+    if not 0 <= index < count:
+        raise ValueError(f"Shard {index} is out of range for {count} shard(s)")
+    return index, count
+
+
+def shard_of(name, count):
+    """Shard a src or media file belongs to: stable across machines and Python runs."""
+    return int(hashlib.sha256(name.encode("utf-8")).hexdigest()[:8], 16) % count
+
+
+def tree_digest(folder, settings):
+    """Digest of every file under folder (paths and contents) and of the settings of a build."""
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    for root, dirs, names in os.walk(folder):
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            digest.update(f"{os.path.relpath(path, folder)}\0{file_hash(path)}\0".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ArtifactCache:
+    """
+    Content-addressed store shared by the runners of a sharded build, e.g. a
+    directory on a shared volume:
+
+        objects/ab/ab12...   rendered files, by the sha256 of their content
+        actions/cd/cd34...   outputs and input hashes of one src file's render,
+                             by src file, content and build settings
+        shards/<build>/<i>-of-<N>.json
+                             what shard i of N rendered for a given src tree
+        media/               the media cache (see MediaCache)
+
+    Everything is written to a temporary name first and renamed, so runners can
+    share the directory without locking.
+    """
+
+    # Bump when the way outputs are rendered changes, to stop reusing old actions
+    version = 2
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.media_folder = os.path.join(folder, "media")
+
+    def _path(self, kind, digest):
+        return os.path.join(self.folder, kind, digest[:2], digest)
+
+    def _read_json(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable artifact {path}: {e}")
+            return None
+
+    def _write_json(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    def store(self, path):
+        """Add the file at path to the store, return its digest."""
+        digest = file_hash(path)
+        target = self._path("objects", digest)
+        if not os.path.exists(target):
+            fast_copy(path, target)
+        return digest
+
+    def has(self, digest):
+        return os.path.exists(self._path("objects", digest))
+
+    def restore(self, digest, destination):
+        fast_copy(self._path("objects", digest), destination)
+
+    @classmethod
+    def action_key(cls, *parts):
+        return hashlib.sha256(json.dumps([cls.version, *parts], sort_keys=True).encode("utf-8")).hexdigest()
+
+    def load_action(self, key):
+        return self._read_json(self._path("actions", key))
+
+    def save_action(self, key, action):
+        self._write_json(self._path("actions", key), action)
+
+    def _shard_path(self, build_id, index, count):
+        return os.path.join(self.folder, "shards", build_id, f"{index}-of-{count}.json")
+
+    def load_shard(self, build_id, index, count):
+        return self._read_json(self._shard_path(build_id, index, count))
+
+    def save_shard(self, build_id, index, count, files):
+        self._write_json(
+            self._shard_path(build_id, index, count),
+            {"build": build_id, "shard": index, "shards": count, "files": files},
+        )
@@ -0,0 +1,295 @@
+"""
+Reproducible benchmark: generates a synthetic site, then times startup (a
+fresh interpreter importing jinjapocalypse), a full render, a no-op
+incremental render and media optimization, each in a fresh process so peak
+RSS is measured per phase.
+
+    python benchmark.py --pages 200 --save-baseline bench.json
+    python benchmark.py --pages 200 --baseline bench.json --max-regression 10
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from loguru import logger
+
+# Imports that only media, data or plugin features should pay for
+HEAVY_MODULES = ("PIL", "requests", "yaml", "http.server")
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore".split()
+
+
+def generate_site(root, pages=200, macros=20, products=2000, fanout=500, jpegs=8, pngs=4, image_size=(1024, 768), seed=42):
+    """Write src/ and media/ of a synthetic site under root, the same for the same arguments."""
+    from PIL import Image
+
+    rng = random.Random(seed)
+    src = os.path.join(root, "src")
+    media = os.path.join(root, "media")
+    os.makedirs(src, exist_ok=True)
+    os.makedirs(media, exist_ok=True)
+
+    def write(name, content):
+        with open(os.path.join(src, name), "w") as f:
+            f.write(content)
+
+    # lib.jinja: M macros, alternating hourri and curly delimiters
+    lib = []
+    for m in range(macros):
+        if m % 2:
+            lib.append(
+                f'/o/ macro card_{m}(item) \\o\\\n<div class="card-{m}"><h3>\\o/ item["name"] \\o/</h3>'
+                f'<p>\\o/ item["description"] \\o/</p><span>\\o/ item["price"] \\o/€</span></div>\n/o/ endmacro \\o\\\n'
+            )
+        else:
+            lib.append(
+                f'{{% macro card_{m}(item) %}}\n<div class="card-{m}"><h3>{{{{ item["name"] }}}}</h3>'
+                f'<ul>{{% for tag in item["tags"] %}}<li>{{{{ tag }}}}</li>{{% endfor %}}</ul></div>\n{{% endmacro %}}\n'
+            )
+    write("lib.jinja", "".join(lib))
+
+    # products.yaml: a large data file shared by every page
+    with open(os.path.join(src, "products.yaml"), "w") as f:
+        for i in range(products):
+            description = " ".join(rng.choice(WORDS) for _ in range(20))
+            tags = ", ".join(rng.sample(WORDS, 3))
+            f.write(f'- name: "Product {i}"\n  price: {rng.randint(1, 999)}\n  description: "{description}"\n  tags: [{tags}]\n')
+
+    write("header.html", "<html><head><title>Bench</title></head><body>\n")
+    write("footer.html", "</body></html>\n")
+
+    per_page = max(1, products // max(pages, 1))
+    for p in range(pages):
+        start = (p * per_page) % products
+        write(
+            f"page_{p}.html",
+            '\\o/ src["header.html"] \\o/\n'
+            f'/o/ for item in _o_["load_yaml"]("products.yaml")[{start}:{start + per_page}] \\o\\\n'
+            f"\\o/ card_{p % macros}(item) \\o/\n"
+            "/o/ endfor \\o\\\n"
+            '\\o/ src["footer.html"] \\o/\n',
+        )
+
+    # start_page fan-out: one template emitting `fanout` pages
+    write(
+        "fanout.html",
+        f'/o/ for item in _o_["load_yaml"]("products.yaml")[:{fanout}] \\o\\\n'
+        '\\o/ _o_["start_page"](item["name"]) \\o/\n'
+        '\\o/ src["header.html"] \\o/\n'
+        "\\o/ card_0(item) \\o/\n"
+        '\\o/ src["footer.html"] \\o/\n'
+        '\\o/ _o_["end_page"]() \\o/\n'
+        "/o/ endfor \\o\\\n",
+    )
+
+    # Images: gradients with seeded noise so that they do not compress for free
+    w, h = image_size
+    for i in range(jpegs + pngs):
+        gradient = Image.merge("RGB", [
+            Image.linear_gradient("L").resize((w, h)),
+            Image.radial_gradient("L").resize((w, h)),
+            Image.linear_gradient("L").rotate(90).resize((w, h)),
+        ])
+        noise = Image.frombytes("RGB", (w, h), rng.randbytes(w * h * 3))
+        img = Image.blend(gradient, noise, 0.15 + 0.1 * (i % 3))
+        if i < jpegs:
+            img.save(os.path.join(media, f"photo_{i}.jpg"), quality=95)
+        elif i % 2:
+            img.quantize(64).save(os.path.join(media, f"graphic_{i}.png"))
+        else:
+            img.save(os.path.join(media, f"picture_{i}.png"))
+
+
+def _folder_size(folder):
+    files = [os.path.join(root, name) for root, _, names in os.walk(folder) for name in names]
+    return len(files), sum(os.path.getsize(f) for f in files)
+
+
+def _peak_rss_mb():
+    # Largest of this process and its --jobs workers; ru_maxrss is in KB on Linux, bytes on macOS
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _run_phase(phase, site, jobs):
+    # Runs in a fresh process: quiet logs, cwd in the site (templates load data from ./src)
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    os.chdir(site)
+
+    from jinjapocalypse import Jinjapocalypse
+    from media_optimizer import MediaOptimizer
+
+    if phase in ("render", "render_noop"):
+        if phase == "render":
+            shutil.rmtree("build", ignore_errors=True)
+        empty_media = os.path.join(site, "no-media")
+        os.makedirs(empty_media, exist_ok=True)
+        instance = Jinjapocalypse(media_folder="no-media", jobs=jobs)
+        started = time.perf_counter()
+        outputs = instance.render_files()
+        seconds = time.perf_counter() - started
+        # Only what was rendered: a no-op build renders nothing
+        size = sum(os.path.getsize(os.path.join("build", output)) for output in set(outputs))
+        return {"seconds": seconds, "pages": len(outputs), "bytes": size, "peak_rss_mb": _peak_rss_mb()}
+
+    if phase == "media":
+        work = os.path.join(site, "media-work")
+        shutil.rmtree(work, ignore_errors=True)
+        shutil.copytree("media", work)
+        images, size = _folder_size(work)
+        optimizer = MediaOptimizer(max_size_kb=300, optimize_png=True, optimize_jpg=True, jobs=jobs)
+        started = time.perf_counter()
+        optimizer.optimize(work)
+        seconds = time.perf_counter() - started
+        return {"seconds": seconds, "images": images, "bytes": size, "peak_rss_mb": _peak_rss_mb()}
+
+    if phase == "startup":
+        # A fresh interpreter importing jinjapocalypse, as a CLI run would
+        check = f"import json, sys, jinjapocalypse; print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+        started = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, "-c", check], cwd=os.path.dirname(os.path.abspath(__file__)),
+            check=True, capture_output=True, text=True,
+        ).stdout
+        seconds = time.perf_counter() - started
+        return {"seconds": seconds, "bytes": 0, "heavy_modules": json.loads(output), "peak_rss_mb": _peak_rss_mb()}
+
+    raise ValueError(f"Unknown phase {phase}")
+
+
+def run(site, phases, repeat=3, jobs=1):
+    """Best of `repeat` runs per phase, each run in a fresh process."""
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for phase in phases:
+        runs = []
+        for _ in range(repeat):
+            # render_noop needs a previous build to be a no-op
+            if phase == "render_noop" and not os.path.exists(os.path.join(site, "build")):
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    executor.submit(_run_phase, "render", site, jobs).result()
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                runs.append(executor.submit(_run_phase, phase, site, jobs).result())
+
+        best = min(runs, key=lambda r: r["seconds"])
+        result = {**best, "peak_rss_mb": max(r["peak_rss_mb"] for r in runs)}
+        seconds = max(result["seconds"], 1e-9)
+        if "pages" in result:
+            result["pages_per_s"] = result["pages"] / seconds
+        if "images" in result:
+            result["images_per_s"] = result["images"] / seconds
+        result["mb_per_s"] = result["bytes"] / (1024 * 1024) / seconds
+        results[phase] = result
+    return results
+
+
+def compare(results, baseline, max_regression=None):
+    """Log each phase against the baseline, return the phases slower than max_regression percent."""
+    regressions = []
+    for phase, result in results.items():
+        previous = baseline.get(phase)
+        if not previous:
+            continue
+        change = (result["seconds"] - previous["seconds"]) / max(previous["seconds"], 1e-9) * 100
+        rss_change = result["peak_rss_mb"] - previous["peak_rss_mb"]
+        logger.info(
+            f"{phase}: {previous['seconds']:.3f}s → {result['seconds']:.3f}s ({change:+.1f}%), "
+            f"peak RSS {rss_change:+.1f} MB"
+        )
+        if max_regression is not None and change > max_regression:
+            regressions.append(phase)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=200, help="Number of plain pages")
+    parser.add_argument("--macros", type=int, default=20, help="Number of macros in lib.jinja")
+    parser.add_argument("--products", type=int, default=2000, help="Number of entries in products.yaml")
+    parser.add_argument("--fanout", type=int, default=500, help="Pages emitted by one template with start_page")
+    parser.add_argument("--jpegs", type=int, default=8, help="Number of generated JPEGs")
+    parser.add_argument("--pngs", type=int, default=4, help="Number of generated PNGs")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the generated content")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per phase, the fastest is kept")
+    parser.add_argument("--jobs", type=int, default=1, help="Passed on to Jinjapocalypse and MediaOptimizer")
+    parser.add_argument(
+        "--phases",
+        default="startup,render,render_noop,media",
+        help="Comma separated phases to run among startup, render, render_noop and media",
+    )
+    parser.add_argument("--site", help="Where to generate the site (default: a temporary directory)")
+    parser.add_argument("--save-baseline", dest="save_baseline", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare the results with this JSON file")
+    parser.add_argument(
+        "--max-regression",
+        dest="max_regression",
+        type=float,
+        help="Exit with an error when a phase is more than this many percent slower than the baseline",
+    )
+    args = parser.parse_args()
+
+    site = args.site or tempfile.mkdtemp(prefix="jinjapocalypse-bench-")
+    shutil.rmtree(os.path.join(site, "src"), ignore_errors=True)
+    shutil.rmtree(os.path.join(site, "media"), ignore_errors=True)
+    shutil.rmtree(os.path.join(site, "build"), ignore_errors=True)
+    logger.info(f"Generating site in {site}")
+    generate_site(
+        site,
+        pages=args.pages,
+        macros=args.macros,
+        products=args.products,
+        fanout=args.fanout,
+        jpegs=args.jpegs,
+        pngs=args.pngs,
+        seed=args.seed,
+    )
+
+    phases = [phase.strip() for phase in args.phases.split(",") if phase.strip()]
+    results = run(site, phases, repeat=args.repeat, jobs=args.jobs)
+    for phase, result in results.items():
+        parts = [f"{result['seconds']:.3f}s"]
+        parts += [f"{result[key]:.1f} {key[:-len('_per_s')]}/s" for key in ("pages_per_s", "images_per_s") if key in result]
+        if result["bytes"]:
+            parts.append(f"{result['mb_per_s']:.1f} MB/s")
+        parts.append(f"peak RSS {result['peak_rss_mb']:.0f} MB")
+        logger.info(f"{phase}: {', '.join(parts)}")
+        if result.get("heavy_modules"):
+            logger.warning(f"Importing jinjapocalypse also imported {', '.join(result['heavy_modules'])}")
+
+    # What the timings depend on, repeat and phases only decide what gets measured
+    parameters = {k: getattr(args, k) for k in ("pages", "macros", "products", "fanout", "jpegs", "pngs", "seed", "jobs")}
+    report = {"parameters": parameters}
+    report.update(results)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=1)
+        logger.info(f"Saved baseline to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("parameters") != parameters:
+            logger.warning("Baseline was recorded with other parameters, comparison may not be meaningful")
+        regressions = compare(results, baseline, args.max_regression)
+        if regressions:
+            logger.error(f"Slower than baseline by more than {args.max_regression}%: {', '.join(regressions)}")
+            sys.exit(1)
+
+    if not args.site:
+        shutil.rmtree(site, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import re
+from collections import deque
+from itertools import islice
+
+from data_loader import parse_yaml
+
+MARKER = "!collection"
+_HEADER_END = re.compile(r"^---[ \t]*$", re.M)
+
+
+class Page:
+    """One page of a paginated collection, as seen by its template."""
+
+    def __init__(self, number, count, items, paths):
+        self.number = number
+        self.count = count
+        self.items = items
+        self.path = paths[number - 1]
+        self.first = paths[0]
+        self.last = paths[-1]
+        self.previous = paths[number - 2] if number > 1 else None
+        self.next = paths[number] if number < count else None
+
+
+class Collection:
+    """
+    A template rendered once per item of a data file, or once per page of
+    `per_page` items. It is declared by a YAML header at the top of the template:
+
+        !collection
+        data: products.csv
+        as: product
+        slug: product["name"]
+        path: "products/{slug}.html"
+        ---
+        <h1>\\o/ product["name"] \\o/</h1>
+
+    `slug` is a Jinja expression, slugified like `_o_["start_page"]` names, and
+    `path` (default `{slug}.html`) places the output. With `per_page`, the
+    template gets a `page` (number, count, items, path, first, last, previous,
+    next) instead, `path` formats `{number}` and page 1 can go to `first_path`.
+    """
+
+    def __init__(
+        self, src_file, data, name="item", slug=None, path=None, per_page=None, first_path=None, delimiter=","
+    ):
+        if per_page is None and slug is None:
+            raise ValueError(f"{src_file}: a collection needs a `slug` expression or `per_page`")
+        if per_page is not None and (not isinstance(per_page, int) or per_page < 1):
+            raise ValueError(f"{src_file}: `per_page` must be a positive number")
+        self.src_file = src_file
+        self.data = data
+        self.name = name
+        self.slug = slug
+        self.path = path or ("{slug}.html" if per_page is None else "page-{number}.html")
+        self.per_page = per_page
+        self.first_path = first_path
+        self.delimiter = delimiter
+
+    @classmethod
+    def parse(cls, src_file, content):
+        """
+        The collection declared by `content` (None if there is none) and the
+        template source. The header is turned into a Jinja comment so that
+        line numbers in errors still match the file.
+        """
+        if not content.startswith(MARKER):
+            return None, content
+        end = _HEADER_END.search(content)
+        if end is None:
+            raise ValueError(f"{src_file}: the {MARKER} header must end with a --- line")
+
+        options = parse_yaml(content[len(MARKER):end.start()]) or {}
+        if not isinstance(options, dict) or "data" not in options:
+            raise ValueError(f"{src_file}: the {MARKER} header must at least give `data`")
+        known = {"data", "as", "slug", "path", "per_page", "first_path", "delimiter"}
+        unknown = set(options) - known
+        if unknown:
+            raise ValueError(f"{src_file}: unknown {MARKER} option(s): {', '.join(sorted(unknown))}")
+
+        options["name"] = options.pop("as", "item")
+        template = "{#" + content[:end.end()] + "#}" + content[end.end():]
+        return cls(src_file, **options), template
+
+    def item_pages(self, items, slug_of, shard=0, shards=1):
+        """(path, variables) of the items this shard renders, every `shards`th one."""
+        for item in islice(items, shard, None, shards):
+            yield self.path.format(slug=slug_of(item)), {self.name: item}
+
+    def index_pages(self, items, count, shard=0, shards=1):
+        """(path, variables) of the pages this shard renders, holding one page of items at a time."""
+        page_count = max(1, -(-count // self.per_page))
+        paths = [self.path.format(number=number) for number in range(1, page_count + 1)]
+        if self.first_path:
+            paths[0] = self.first_path
+
+        items = iter(items)
+        for index in range(page_count):
+            if index % shards != shard:
+                deque(islice(items, self.per_page), maxlen=0)
+                continue
+            page_items = list(islice(items, self.per_page))
+            yield paths[index], {"page": Page(index + 1, page_count, page_items, paths)}
@@ -0,0 +1,114 @@
+import csv
+import json
+import os
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def _yaml():
+    # PyYAML is only imported by the first YAML load
+    import yaml
+
+    try:
+        return yaml, yaml.CSafeLoader
+    except AttributeError:
+        return yaml, yaml.SafeLoader
+
+
+def parse_yaml(text):
+    yaml, loader = _yaml()
+    return yaml.load(text, Loader=loader)
+
+
+class FrozenDict(dict):
+    """A dict that refuses to change; `.copy()` returns a plain, mutable dict."""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Loaded data is shared between templates and read-only, use .copy() first")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def copy(self):
+        return dict(self)
+
+    def __reduce__(self):
+        return FrozenDict, (dict(self),)
+
+
+def freeze(data):
+    if isinstance(data, dict):
+        return FrozenDict((key, freeze(value)) for key, value in data.items())
+    if isinstance(data, list):
+        return tuple(freeze(value) for value in data)
+    return data
+
+
+class DataLoader:
+    """
+    Parses each data file once and serves the same read-only result to every
+    caller until the file's mtime or size changes, which keeps long-running
+    builds (watch mode) correct without re-parsing on every render.
+    """
+
+    def __init__(self, folder="src"):
+        self.folder = folder
+        self._cache = {}
+
+    def _load(self, path, parse, *options):
+        full_path = os.path.join(self.folder, path)
+        st = os.stat(full_path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        key = (parse.__name__, path, options)
+
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        with open(full_path, newline="") as f:
+            data = freeze(parse(f, *options))
+        self._cache[key] = (stamp, data)
+        return data
+
+    @staticmethod
+    def _parse_yaml(f):
+        return parse_yaml(f)
+
+    @staticmethod
+    def _parse_json(f):
+        return json.load(f)
+
+    @staticmethod
+    def _parse_csv(f, delimiter):
+        return list(csv.DictReader(f, delimiter=delimiter))
+
+    def load_yaml(self, path):
+        return self._load(path, self._parse_yaml)
+
+    def load_json(self, path):
+        return self._load(path, self._parse_json)
+
+    def load_csv(self, path, delimiter=","):
+        return self._load(path, self._parse_csv, delimiter)
+
+    def iter_items(self, path, delimiter=","):
+        """
+        Yield the items of a list-shaped data file. CSV rows and JSON Lines
+        (.jsonl/.ndjson) are read one at a time and never cached, so they can
+        be bigger than memory; YAML and JSON files go through the shared cache.
+        """
+        ext = os.path.splitext(path)[1].lower()
+        full_path = os.path.join(self.folder, path)
+        if ext == ".csv":
+            with open(full_path, newline="") as f:
+                yield from csv.DictReader(f, delimiter=delimiter)
+        elif ext in (".jsonl", ".ndjson"):
+            with open(full_path) as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+        else:
+            data = self.load_json(path) if ext == ".json" else self.load_yaml(path)
+            if not isinstance(data, (list, tuple)):
+                raise ValueError(f"{path} does not hold a list of items")
+            yield from data
@@ -0,0 +1,114 @@
+import json
+import os
+
+from loguru import logger
+
+from incremental import file_hash
+from sync import fast_copy
+
+FINGERPRINT_EXTENSIONS = (
+    ".css", ".js", ".mjs", ".map",
+    ".png", ".jpg", ".jpeg", ".gif", ".svg", ".webp", ".avif", ".ico",
+    ".woff", ".woff2", ".ttf", ".otf", ".eot",
+)
+DIGEST_LENGTH = 10
+
+
+def fingerprintable(path):
+    name = os.path.basename(path)
+    return not name.startswith(".") and os.path.splitext(name)[1].lower() in FINGERPRINT_EXTENSIONS
+
+
+def fingerprinted_name(path, digest):
+    base, ext = os.path.splitext(path)
+    return f"{base}.{digest}{ext}"
+
+
+class AssetManifest:
+    """
+    Long-cache names of the static files in the build folder, keyed by their
+    build-relative path:
+
+        {"css/site.css": {"name": "css/site.0f3c9a1d2e.css", "size": ..., "mtime_ns": ...}}
+
+    The digest is the start of the content's sha256, the same as `_o_["hash"]`,
+    so an unchanged file keeps its name from one build to the next.
+    """
+
+    filename = "assets.json"
+
+    def __init__(self, build_folder):
+        self.build_folder = build_folder
+        self.path = os.path.join(build_folder, self.filename)
+        self.assets = {}
+
+    @classmethod
+    def load(cls, build_folder):
+        manifest = cls(build_folder)
+        try:
+            with open(manifest.path) as f:
+                manifest.assets = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable asset manifest {manifest.path}: {e}")
+        return manifest
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.assets, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def resolve(self, relative_path):
+        """Fingerprinted name of a build file, hashing it only when its size or mtime changed."""
+        st = os.stat(os.path.join(self.build_folder, relative_path))
+        entry = self.assets.get(relative_path)
+        if entry is None or (entry["size"], entry["mtime_ns"]) != (st.st_size, st.st_mtime_ns):
+            digest = file_hash(os.path.join(self.build_folder, relative_path))[:DIGEST_LENGTH]
+            entry = {"name": fingerprinted_name(relative_path, digest), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+            self.assets[relative_path] = entry
+        return entry["name"]
+
+    def fingerprint(self):
+        """
+        Give every static file in the build folder a fingerprinted copy (a
+        hardlink where possible), remove the copies of files that changed or
+        disappeared, and save the manifest.
+        """
+        previous = {entry["name"] for entry in self.assets.values()}
+        found = set()
+        for root, dirs, names in os.walk(self.build_folder):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for name in names:
+                relative_path = os.path.relpath(os.path.join(root, name), self.build_folder)
+                if fingerprintable(relative_path) and relative_path not in previous:
+                    found.add(relative_path)
+
+        created = 0
+        for relative_path in sorted(found):
+            target = os.path.join(self.build_folder, self.resolve(relative_path))
+            if not os.path.exists(target):
+                fast_copy(os.path.join(self.build_folder, relative_path), target, link=True)
+                created += 1
+
+        self.assets = {path: entry for path, entry in self.assets.items() if path in found}
+        current = {entry["name"] for entry in self.assets.values()}
+        for name in previous - current:
+            path = os.path.join(self.build_folder, name)
+            if os.path.exists(path):
+                os.remove(path)
+                logger.info(f"Removed stale {path}")
+
+        self.save()
+        logger.info(f"Fingerprinted {len(found)} asset(s), {created} new")
+
+    def remove(self):
+        """Remove every fingerprinted copy and the manifest, once fingerprinting is turned off."""
+        for entry in self.assets.values():
+            path = os.path.join(self.build_folder, entry["name"])
+            if os.path.exists(path):
+                os.remove(path)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+            logger.info(f"Removed {len(self.assets)} fingerprinted asset(s) and {self.path}")
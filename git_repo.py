@@ -1,3 +1,7 @@
+import hashlib
+import json
+import os
+import re
 import shutil
 import subprocess
 import tempfile
@@ -5,15 +9,36 @@ from pathlib import Path
 
 from loguru import logger
 
+from sync import fast_copy
+
 
 class GitRepoSource:
-    def __init__(self, repo_url):
+    """
+    src/ and media/ of a git repository.
+
+    Without `cache_dir` every call does a fresh sparse clone. With it, a sparse
+    mirror is kept under `cache_dir` and updated with shallow fetches, and only
+    the paths that changed since the last sync are copied out of it. The mirror
+    checkout can also be built from directly (see `checkout_path`).
+    """
+
+    folders = ("src", "media")
+    state_filename = "jinjapocalypse-sync.json"
+
+    def __init__(self, repo_url, cache_dir=None, ref="HEAD"):
         self.repo_url = repo_url
+        self.cache_dir = cache_dir
+        self.ref = ref
 
     def _run(self, command, cwd=None):
         logger.info("Running: {}", " ".join(command))
         subprocess.run(command, cwd=cwd, check=True)
 
+    def _git_output(self, *args):
+        return subprocess.run(
+            ["git", "-C", str(self.mirror_path), *args], check=True, capture_output=True, text=True
+        ).stdout
+
     def _clone_sparse(self, destination):
         self._run(
             [
@@ -27,24 +52,117 @@ class GitRepoSource:
                 str(destination),
             ]
         )
-        self._run(["git", "-C", str(destination), "sparse-checkout", "set", "src", "media"])
+        self._run(["git", "-C", str(destination), "sparse-checkout", "set", *self.folders])
+
+    @property
+    def mirror_path(self):
+        name = re.sub(r"[^\w.-]+", "-", self.repo_url.rstrip("/").rsplit("/", 1)[-1]) or "repo"
+        digest = hashlib.sha256(self.repo_url.encode("utf-8")).hexdigest()[:12]
+        return Path(self.cache_dir) / f"{name}-{digest}"
+
+    def update_mirror(self):
+        """Clone or fetch the mirror, check out `ref` and return its commit."""
+        mirror = self.mirror_path
+        fresh = not (mirror / ".git").is_dir()
+        if fresh:
+            shutil.rmtree(mirror, ignore_errors=True)
+            mirror.parent.mkdir(parents=True, exist_ok=True)
+            self._clone_sparse(mirror)
+
+        head = self._git_output("rev-parse", "HEAD").strip()
+        if fresh and self.ref == "HEAD":
+            return head
+
+        self._run(["git", "-C", str(mirror), "fetch", "--depth", "1", "--filter=blob:none", "origin", self.ref])
+        fetched = self._git_output("rev-parse", "FETCH_HEAD").strip()
+        if fetched != head:
+            self._run(["git", "-C", str(mirror), "reset", "--hard", "--quiet", fetched])
+        else:
+            logger.info("{} is up to date at {}", self.repo_url, head[:12])
+        return fetched
+
+    def checkout_path(self):
+        """Update the mirror and return its working tree, to build from without copying."""
+        if self.cache_dir is None:
+            raise ValueError("Building from the checkout needs a cache directory")
+        self.update_mirror()
+        return self.mirror_path
+
+    def _load_state(self):
+        try:
+            with open(self.mirror_path / ".git" / self.state_filename) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self, state):
+        path = self.mirror_path / ".git" / self.state_filename
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+        os.replace(f"{path}.tmp", path)
+
+    def _copy_folders(self, checkout_dir, destination_root):
+        for folder_name in self.folders:
+            source_path = checkout_dir / folder_name
+            destination_path = destination_root / folder_name
+
+            try:
+                if destination_path.exists():
+                    shutil.rmtree(destination_path)
+                shutil.copytree(source_path, destination_path, copy_function=fast_copy)
+                logger.info("Copied {} to {}", source_path, destination_path)
+            except FileNotFoundError:
+                if folder_name == "src":
+                    raise RuntimeError(f"{folder_name}/ was not found in {self.repo_url}")
+                logger.info("{} was not found in {}; skipping", folder_name, self.repo_url)
+
+    def _changes(self, old, new):
+        # (status, path) pairs of src/ and media/ files that differ between two commits
+        output = self._git_output("diff", "--name-status", "--no-renames", "-z", old, new, "--", *self.folders)
+        fields = output.split("\0")[:-1]
+        return list(zip(fields[0::2], fields[1::2]))
+
+    def _apply_changes(self, changes, destination_root):
+        for status, path in changes:
+            destination_path = destination_root / path
+            if status == "D":
+                if destination_path.exists():
+                    destination_path.unlink()
+                    logger.info("Removed {}", destination_path)
+                parent = destination_path.parent
+                while parent != destination_root and parent.is_dir() and not any(parent.iterdir()):
+                    parent.rmdir()
+                    parent = parent.parent
+            else:
+                fast_copy(str(self.mirror_path / path), str(destination_path))
+                logger.info("Updated {}", destination_path)
 
     def copy_source_tree(self, destination_root="."):
-        with tempfile.TemporaryDirectory(prefix="jinjapocalypse-git-") as temp_dir:
-            checkout_dir = Path(temp_dir) / "repo"
-            self._clone_sparse(checkout_dir)
-
-            destination_root = Path(destination_root)
-            for folder_name in ("src", "media"):
-                source_path = checkout_dir / folder_name
-                destination_path = destination_root / folder_name
-
-                try:
-                    if destination_path.exists():
-                        shutil.rmtree(destination_path)
-                    shutil.copytree(source_path, destination_path)
-                    logger.info("Copied {} to {}", source_path, destination_path)
-                except FileNotFoundError:
-                    if folder_name == "src":
-                        raise RuntimeError(f"{folder_name}/ was not found in {self.repo_url}")
-                    logger.info("{} was not found in {}; skipping", folder_name, self.repo_url)
+        destination_root = Path(destination_root)
+        if self.cache_dir is None:
+            with tempfile.TemporaryDirectory(prefix="jinjapocalypse-git-") as temp_dir:
+                checkout_dir = Path(temp_dir) / "repo"
+                self._clone_sparse(checkout_dir)
+                self._copy_folders(checkout_dir, destination_root)
+            return
+
+        head = self.update_mirror()
+        state = self._load_state()
+        key = str(destination_root.resolve())
+        synced = state.get(key)
+
+        changes = None
+        if synced is not None and (destination_root / "src").is_dir():
+            try:
+                changes = self._changes(synced, head)
+            except subprocess.CalledProcessError:
+                logger.info("Last synced commit {} is gone from the mirror", synced[:12])
+
+        if changes is None:
+            self._copy_folders(self.mirror_path, destination_root)
+        else:
+            logger.info("{} path(s) changed since {}", len(changes), synced[:12])
+            self._apply_changes(changes, destination_root)
+
+        state[key] = head
+        self._save_state(state)
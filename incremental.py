@@ -0,0 +1,183 @@
+import contextvars
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+
+from loguru import logger
+
+_DEPENDENCIES = contextvars.ContextVar("jinjapocalypse_dependencies", default=None)
+
+
+def record_dependency(kind, name=""):
+    """Note that whatever is currently rendering read `kind:name`."""
+    dependencies = _DEPENDENCIES.get()
+    if dependencies is not None:
+        dependencies.add(f"{kind}:{name}")
+
+
+@contextmanager
+def recording(dependencies):
+    token = _DEPENDENCIES.set(dependencies)
+    try:
+        yield dependencies
+    finally:
+        _DEPENDENCIES.reset(token)
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BuildManifest:
+    """
+    Dependency graph of the previous build, persisted in the state folder.
+
+    For each src file we keep the inputs its rendering touched (`src:<path>`,
+    `data:<path>`, `lib:`, `build:<path>` for media metadata, `plugin:<namespace>`)
+    and the outputs it wrote, along with the settings the build ran with.
+    Inputs are fingerprinted by size, mtime and content hash; plugin inputs
+    live outside the tree and are always considered changed.
+    """
+
+    filename = "build-manifest.json"
+    version = 1
+
+    def __init__(self, state_folder, build_folder, src_folder, settings=None):
+        self.state_folder = state_folder
+        self.build_folder = build_folder
+        self.src_folder = src_folder
+        self.path = os.path.join(state_folder, self.filename)
+        self.settings = settings
+        self.previous_settings = None
+        self.inputs = {}
+        self.files = {}
+        self._fingerprints = {}
+
+    @classmethod
+    def load(cls, state_folder, build_folder, src_folder, settings=None):
+        manifest = cls(state_folder, build_folder, src_folder, settings)
+        try:
+            with open(manifest.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return manifest
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable build manifest {manifest.path}: {e}")
+            return manifest
+
+        if data.get("version") != cls.version:
+            logger.info("Build manifest is from another version, rebuilding everything")
+            return manifest
+
+        manifest.inputs = data.get("inputs", {})
+        manifest.files = data.get("files", {})
+        manifest.previous_settings = data.get("settings")
+        if manifest.previous_settings != settings:
+            logger.info("Build settings changed, rendering everything")
+            # The outputs are kept, to be pruned once the new ones are known
+            for src_file in manifest.files:
+                manifest.invalidate(src_file)
+        return manifest
+
+    def save(self):
+        used = {dep for entry in self.files.values() for dep in entry["deps"]}
+        self.inputs = {dep: fp for dep, fp in self.inputs.items() if dep in used}
+        data = {"version": self.version, "settings": self.settings, "inputs": self.inputs, "files": self.files}
+
+        os.makedirs(self.state_folder, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def _input_path(self, dep):
+        kind, name = dep.split(":", 1)
+        if kind in ("src", "data"):
+            return os.path.join(self.src_folder, name)
+        if kind == "lib":
+            return os.path.join(self.src_folder, "lib.jinja")
+        if kind == "build":
+            return os.path.join(self.build_folder, name)
+        return None
+
+    def fingerprint(self, dep):
+        if dep in self._fingerprints:
+            return self._fingerprints[dep]
+
+        path = self._input_path(dep)
+        if path is None:
+            fingerprint = None
+        else:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                fingerprint = {"hash": None}
+            else:
+                previous = self.inputs.get(dep) or {}
+                if previous.get("size") == st.st_size and previous.get("mtime_ns") == st.st_mtime_ns:
+                    fingerprint = previous
+                else:
+                    fingerprint = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "hash": file_hash(path)}
+
+        self._fingerprints[dep] = fingerprint
+        return fingerprint
+
+    def _changed(self, dep):
+        if dep not in self.inputs:
+            return True
+        fingerprint = self.fingerprint(dep)
+        return fingerprint is None or fingerprint.get("hash") != self.inputs[dep].get("hash")
+
+    def closure(self, src_files):
+        """All src files whose rendered content `src_files` (transitively) read."""
+        seen, pending = set(), list(src_files)
+        while pending:
+            src_file = pending.pop()
+            if src_file in seen:
+                continue
+            seen.add(src_file)
+            for dep in self.files.get(src_file, {}).get("deps", []):
+                if dep.startswith("src:"):
+                    pending.append(dep[len("src:"):])
+        return seen
+
+    def dirty_files(self, src_files):
+        dirty = set()
+        for src_file in src_files:
+            entry = self.files.get(src_file)
+            if entry is None or entry.get("invalid"):
+                dirty.add(src_file)
+                continue
+
+            deps = {dep for f in self.closure([src_file]) for dep in self.files.get(f, {}).get("deps", [])}
+            deps.add(f"src:{src_file}")
+            if any(self._changed(dep) for dep in deps):
+                dirty.add(src_file)
+            elif not all(os.path.exists(os.path.join(self.build_folder, o)) for o in entry["outputs"]):
+                dirty.add(src_file)
+        return dirty
+
+    def outputs(self, src_file):
+        return self.files.get(src_file, {}).get("outputs", [])
+
+    def record(self, src_file, deps, outputs):
+        deps = set(deps) | {f"src:{src_file}"}
+        self.files[src_file] = {"deps": sorted(deps), "outputs": sorted(set(outputs))}
+        for dep in deps:
+            fingerprint = self.fingerprint(dep)
+            if fingerprint is not None:
+                self.inputs[dep] = fingerprint
+            else:
+                self.inputs.pop(dep, None)
+
+    def invalidate(self, src_file):
+        """Render src_file again next build, its outputs are still pruned then."""
+        self.files[src_file] = {"deps": [], "outputs": self.outputs(src_file), "invalid": True}
+
+    def forget(self, src_file):
+        return self.files.pop(src_file, {}).get("outputs", [])
@@ -1,26 +1,134 @@
 import argparse
-import json
 import os
 import random
-import shutil
-import yaml
-from jinja2 import Environment, FileSystemLoader
+import tempfile
+import time
+from itertools import groupby, islice
+from jinja2 import ChoiceLoader, FileSystemLoader
 from loguru import logger
-import re
+import traceback
 
+import profiling
+from artifacts import ArtifactCache, parse_shard, shard_of, tree_digest
+from collection import Collection
 from git_repo import GitRepoSource
+from fingerprint import AssetManifest, fingerprintable
+from incremental import BuildManifest, file_hash, recording
+from media_index import MediaIndex
+from passthrough import is_passthrough
+from postprocess import OutputProcessor
 from toolbox import Toolbox
-from media_optimizer import MediaOptimizer
+from responsive import VariantManifest
+from sections import OutputFile, SectionScanner
+from sync import MediaSync, fast_copy
+from templating import ContentBytecodeCache, HourriEnvironment, RenderedSources, SourceLoader
+
+# State files older versions wrote into the build folder
+LEGACY_STATE_FILES = (
+    ".jinjapocalypse-manifest.json",
+    ".jinjapocalypse-media.json",
+    ".jinjapocalypse-compressed.json",
+    ".jinjapocalypse-media-index.json",
+)
+
+_WORKER = None
+_WORKER_LOGS = []
+
+
+def _init_worker(instance):
+    global _WORKER
+    _WORKER = instance
+    profiling.drain()
+    logger.remove()
+    logger.add(lambda message: _WORKER_LOGS.append((message.record["level"].name, message.record["message"])))
+
+
+def _build_in_worker(task):
+    src_file, shard, shards = task
+    _WORKER_LOGS.clear()
+    try:
+        outputs, error = _WORKER.build_file(src_file, shard, shards), None
+    except Exception:
+        outputs, error = [], traceback.format_exc()
+    # The deps of what src_file includes too, those were rendered in this worker
+    deps = {f: _WORKER.dependencies.get(f, set()) for f in _WORKER.included_files(src_file)}
+    return src_file, outputs, deps, list(_WORKER_LOGS), profiling.drain(), error
+
 
 class Jinjapocalypse:
-    def __init__(self, src_folder="src", build_folder="build", media_folder="media"):
+    def __init__(
+        self,
+        src_folder="src",
+        build_folder="build",
+        media_folder="media",
+        bytecode_cache=None,
+        incremental=True,
+        jobs=1,
+        media_cache=None,
+        media_memory_mb=None,
+        media_max_megapixels=None,
+        responsive_widths=(),
+        fingerprint=False,
+        passthrough=(),
+        minify=False,
+        precompress=False,
+        shard=None,
+        artifact_cache=None,
+        state_folder=".cache/jinjapocalypse",
+    ):
         self.src_folder = src_folder
         self.build_folder = build_folder
         self.media_folder = media_folder
-        self.context = {"src": {}}
+        # What incremental builds remember (manifests, stamps), kept out of the published build folder
+        self.state_folder = state_folder
+        # Media is published as build/<last part of media_folder>, wherever it is read from
+        self.media_name = os.path.basename(os.path.normpath(media_folder))
+        self.bytecode_cache = bytecode_cache
+        self.incremental = incremental
+        self.fingerprint = fingerprint
+        # Extra globs (on src-relative paths) of files copied as-is instead of rendered
+        self.passthrough_patterns = tuple(passthrough)
+        self.minify = minify
+        self.precompress = precompress
+        # (index, count) when this process builds one shard of a build split across runners
+        self.shard = shard
+        self.artifacts = ArtifactCache(artifact_cache) if artifact_cache else None
+        if self.artifacts is not None and media_cache is None:
+            media_cache = self.artifacts.media_folder
+        self.jobs = jobs if jobs > 0 else os.cpu_count()
+        self.sources = {}
+        self.passthrough = set()
+        self.collections = {}
+        self.context = {
+            "src": RenderedSources(self.sources, self.render_source, self.stream_source, self.passthrough)
+        }
         self.no_render_files = set()
+        self.dependencies = {}
+        self.env = None
+        self.lib_exports = set()
+        # What lib.jinja's top-level code read, a dependency of every file
+        self.lib_dependencies = set()
         self.ensure_directories_exist()
-        self.optimizer = MediaOptimizer(max_size_kb=300, optimize_png=True, optimize_jpg=True)
+        self.optimizer_options = {
+            "max_size_kb": 300,
+            "optimize_png": True,
+            "optimize_jpg": True,
+            "cache_dir": media_cache,
+            "jobs": self.jobs,
+            "max_memory_mb": media_memory_mb,
+            "max_pixels": media_max_megapixels * 1_000_000 if media_max_megapixels else None,
+            "variant_widths": responsive_widths,
+        }
+        self._optimizer = None
+
+    @property
+    def optimizer(self):
+        # Pillow is only imported by builds that have media
+        if self._optimizer is None:
+            from media_optimizer import MediaOptimizer
+
+            self._optimizer = MediaOptimizer(**self.optimizer_options)
+        return self._optimizer
 
     def ensure_directories_exist(self):
         # Create directories if they do not exist and log their creation
@@ -28,28 +136,85 @@ class Jinjapocalypse:
             if not os.path.exists(folder):
                 os.makedirs(folder, exist_ok=True)
                 logger.info(f"Created directory: {folder}")
+        # Older versions kept their state in the build folder, where it got published
+        for name in LEGACY_STATE_FILES:
+            path = os.path.join(self.build_folder, name)
+            if os.path.exists(path):
+                os.remove(path)
+                logger.info(f"Removed {path}, build state now lives in {self.state_folder}")
+
+    def create_environment(self):
+        bytecode_cache = None
+        if self.bytecode_cache:
+            os.makedirs(self.bytecode_cache, exist_ok=True)
+            bytecode_cache = ContentBytecodeCache(self.bytecode_cache)
 
-    def render_template(self, template_path, lib_content):
-        env = Environment(
-            loader=FileSystemLoader(self.src_folder),
+        return HourriEnvironment(
+            loader=ChoiceLoader([SourceLoader(self.sources), FileSystemLoader(self.src_folder)]),
+            bytecode_cache=bytecode_cache,
+            cache_size=-1,
             trim_blocks=True,
-            block_start_string="/o/",
-            block_end_string="\\o\\",
-            variable_start_string="\\o/",
-            variable_end_string="\\o/",
         )
 
-        # Prepend lib_content to the template content before rendering
-        full_content = lib_content + self.context["src"][template_path]
-        # Allow using plain jinja instead of hourris, nice for writing lib.ninja
-        full_content = full_content.replace("{{", "\\o/")
-        full_content = full_content.replace("}}", "\\o/")
-        full_content = full_content.replace("{%", "/o/")
-        full_content = full_content.replace("%}", "\\o\\")
-        return env.from_string(full_content).render(self.context, _o_=Toolbox())
+    def load_lib(self):
+        # Compile lib.jinja once and expose its macros to every template
+        for name in self.lib_exports:
+            self.env.globals.pop(name, None)
+        self.lib_exports = set()
+        self.lib_dependencies = set()
 
-    def copy_files(self, source_folder, destination_folder):
-        shutil.copytree(source_folder, destination_folder, dirs_exist_ok=True)
+        lib_jinja_path = os.path.join(self.src_folder, "lib.jinja")
+        if not os.path.exists(lib_jinja_path):
+            logger.warning("lib.jinja not found. No macros will be available.")
+            return
+
+        with recording(self.lib_dependencies):
+            lib = self.env.get_template("lib.jinja").make_module(self.context)
+        exported = {name: value for name, value in vars(lib).items() if not name.startswith("_")}
+        self.env.globals.update(exported)
+        self.lib_exports = set(exported)
+        logger.info(f"Loaded {len(exported)} definition(s) from lib.jinja")
+
+    def file_dependencies(self, src_file):
+        # The set rendering src_file records into, starting with lib.jinja and what it read
+        return self.dependencies.setdefault(src_file, {"lib:", *self.lib_dependencies})
+
+    def render_template(self, template_path):
+        return self.env.get_template(template_path).render(self.context)
+
+    def render_source(self, src_file):
+        # Called by the src mapping the first time a file is looked up
+        if src_file in self.passthrough:
+            logger.info(f"Reading {src_file} as-is because a template includes it")
+            with open(os.path.join(self.src_folder, src_file), "r", errors="replace") as file:
+                return file.read()
+        if src_file in self.collections:
+            raise RuntimeError(f"{src_file} is a collection template, it can't be included")
+
+        content = self.sources[src_file]
+        if content.startswith("!norender"):
+            logger.info(f"Rendering {src_file} as-is because of !norender")
+            self.no_render_files.add(src_file)
+            return self.strip_norender_marker(content)
+
+        logger.info(f"Rendering {src_file}")
+        with recording(self.file_dependencies(src_file)):
+            return self.render_template(src_file)
+
+    def stream_source(self, src_file):
+        # Same as render_source, but yields jinja's output as it is generated
+        content = self.sources[src_file]
+        if content.startswith("!norender"):
+            yield self.render_source(src_file)
+            return
+
+        logger.info(f"Rendering {src_file}")
+        template = self.env.get_template(src_file)
+        with recording(self.file_dependencies(src_file)):
+            # Jinja yields tiny chunks, hand them on in batches
+            chunks = template.generate(self.context)
+            while batch := list(islice(chunks, 4096)):
+                yield "".join(batch)
 
     def strip_norender_marker(self, content):
         if content.startswith("!norender"):
@@ -60,18 +225,7 @@ class Jinjapocalypse:
                 content = content[1:]
         return content
 
-    def process_files(self):
-        os.makedirs(self.build_folder, exist_ok=True)
-
-        # Read lib.jinja content
-        lib_jinja_path = os.path.join(self.src_folder, "lib.jinja")
-        if os.path.exists(lib_jinja_path):
-            with open(lib_jinja_path, "r") as lib_file:
-                lib_content = lib_file.read()
-        else:
-            lib_content = ""
-            logger.warning("lib.jinja not found. No macros will be prepended.")
-
+    def collect_src_files(self):
         # Recursively collect all file paths under src_folder
         src_files = []
         for root, _, files in os.walk(self.src_folder):
@@ -80,101 +234,545 @@ class Jinjapocalypse:
                 relative_path = os.path.relpath(full_path, self.src_folder)
                 if file != "lib.jinja":  # Exclude lib.jinja from the list of files to process
                     src_files.append(relative_path)
+        return src_files
+
+    def build_file(self, src_file, shard=0, shards=1):
+        # A collection can be split in shards rendered by different workers,
+        # within the shard of the build this process renders
+        if self.shard is not None and src_file in self.collections:
+            index, count = self.shard
+            shard, shards = index + count * shard, count * shards
+        started = time.perf_counter()
+        timings = profiling.Breakdown()
+        if src_file in self.collections:
+            outputs = self.build_collection(src_file, timings, shard, shards)
+        else:
+            outputs = self.stream_to_disk(src_file, timings)
+        profiling.add(
+            "build", "render", started, time.perf_counter() - started,
+            file=src_file, outputs=len(outputs), **timings.seconds,
+        )
+        return outputs
+
+    def build_collection(self, src_file, timings, shard=0, shards=1):
+        # One output per item (or page of items), items are streamed from the data file
+        collection = self.collections[src_file]
+        toolbox = self.env.globals["_o_"]
+        with timings("compile"):
+            template = self.env.get_template(src_file)
+        logger.info(f"Rendering collection {src_file} from {collection.data}")
+
+        outputs = []
+        with recording(self.file_dependencies(src_file)):
+            items = toolbox.iter_items(collection.data, collection.delimiter)
+            if collection.per_page is None:
+                slug = self.env.compile_expression(collection.slug)
+                pages = collection.item_pages(
+                    items, lambda item: Toolbox.slugify(str(slug(**{collection.name: item}))), shard, shards
+                )
+            else:
+                count = sum(1 for _ in toolbox.iter_items(collection.data, collection.delimiter))
+                pages = collection.index_pages(items, count, shard, shards)
+
+            for path, variables in timings.iterate("render", pages):
+                with timings("render"):
+                    content = template.render({**self.context, **variables})
+                outputs.extend(self.write_output([content], path, timings))
+        return outputs
+
+    def stream_to_disk(self, src_file, timings):
+        if not self.sources[src_file].startswith("!norender"):
+            with timings("compile"):
+                self.env.get_template(src_file)
+        chunks = timings.iterate("render", self.context["src"].stream(src_file))
+        return self.write_output(chunks, src_file, timings)
+
+    def write_output(self, chunks, output, timings):
+        # Stream rendered chunks to build/output, writing each section page as soon as it closes
+        outputs = []
+
+        def write_section(section):
+            with timings("write"):
+                page_name = self.write_section(section)
+            if page_name:
+                outputs.append(page_name)
+
+        def write_lines(lines):
+            with timings("write"):
+                build_file.write_lines(lines)
+
+        build_file_path = os.path.join(self.build_folder, output)
+        with OutputFile(build_file_path) as build_file:
+            scanner = SectionScanner(write_lines, write_section)
+            for chunk in chunks:
+                with timings("sections"):
+                    scanner.feed(chunk)
+            with timings("sections"):
+                scanner.close()
 
-        # Read and store content of each file
+            if outputs:
+                logger.info(f"Wrote {len(outputs)} page(s) from sections of {output}")
+            with timings("write"):
+                written = build_file.close()
+            if not written:
+                logger.warning(f"Not rendering {output} as its final content is empty")
+                return outputs
+
+        logger.info(f"Wrote {build_file_path}")
+        outputs.append(output)
+        return outputs
+
+    def build_files_in_parallel(self, src_files):
+        # Workers are forked from this process so they start with the environment,
+        # lib.jinja and sources already loaded. Their logs are replayed here in
+        # src order so the output does not depend on scheduling. Collections are
+        # split in one shard per job.
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        logger.info(f"Rendering {len(src_files)} file(s) with {self.jobs} jobs")
+        tasks = [
+            (src_file, shard, shards)
+            for src_file in src_files
+            for shards in [self.jobs if src_file in self.collections else 1]
+            for shard in range(shards)
+        ]
+        failures = []
+        chunksize = max(1, len(tasks) // (self.jobs * 4))
+        with ProcessPoolExecutor(
+            max_workers=self.jobs,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_worker,
+            initargs=(self,),
+        ) as executor:
+            results = executor.map(_build_in_worker, tasks, chunksize=chunksize)
+            for src_file, shard_results in groupby(results, key=lambda result: result[0]):
+                outputs, deps, errors = [], set(), []
+                for _, shard_outputs, shard_deps, logs, events, error in shard_results:
+                    for level, message in logs:
+                        logger.log(level, message)
+                    profiling.extend(events)
+                    outputs.extend(shard_outputs)
+                    deps |= shard_deps.get(src_file, set())
+                    for included, included_deps in shard_deps.items():
+                        self.dependencies.setdefault(included, set()).update(included_deps)
+                    if error:
+                        errors.append(error)
+                if errors:
+                    logger.error(f"Failed to build {src_file}:\n{''.join(errors)}")
+                    failures.append(src_file)
+                    continue
+                yield src_file, outputs, deps
+
+        if failures:
+            raise RuntimeError(f"{len(failures)} file(s) failed to build: {', '.join(failures)}")
+
+    def included_files(self, src_file):
+        # src_file and every src file it (transitively) included, as rendered by this process
+        seen, pending = set(), [src_file]
+        while pending:
+            name = pending.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            pending.extend(dep[len("src:"):] for dep in self.dependencies.get(name, ()) if dep.startswith("src:"))
+        return seen
+
+    def remove_outputs(self, outputs):
+        for output in outputs:
+            build_file_path = os.path.join(self.build_folder, output)
+            if os.path.exists(build_file_path):
+                os.remove(build_file_path)
+                logger.info(f"Removed stale {build_file_path}")
+
+    def process_files(self):
+        # Media first: templates can read what the media stage produced
+        with profiling.span("process_media", "build"):
+            self.process_media()
+        with profiling.span("render_files", "build"):
+            self.render_files()
+        logger.info("All done")
+
+    def load_sources(self):
+        os.makedirs(self.build_folder, exist_ok=True)
+
+        # The environment outlives a build so that watch mode keeps templates compiled
+        if self.env is None:
+            self.env = self.create_environment()
+            self.env.globals["_o_"] = Toolbox(self.build_folder, self.media_name, self.src_folder, self.fingerprint)
+        self.load_lib()
+
+        src_files = self.collect_src_files()
+
+        # Read and store content of each file, rendering happens on first lookup.
+        # Passthrough files are not read at all, they are copied to the build folder.
+        self.sources.clear()
+        self.passthrough.clear()
+        self.collections.clear()
+        self.context["src"].clear()
+        self.dependencies.clear()
         for src_file in src_files:
             file_path = os.path.join(self.src_folder, src_file)
             logger.info(f"Found {src_file}...")
-            with open(file_path, "r") as file:
-                content = file.read()
-                self.context["src"][src_file] = content
+            if is_passthrough(src_file, file_path, self.passthrough_patterns):
+                self.passthrough.add(src_file)
+                continue
+            try:
+                with open(file_path, "r") as file:
+                    content = file.read()
+            except UnicodeDecodeError:
+                self.passthrough.add(src_file)
+                continue
+            collection, self.sources[src_file] = Collection.parse(src_file, content)
+            if collection is not None:
+                self.collections[src_file] = collection
+        return src_files
 
-        # Render (or copy) each file to the build directory
-        logger.info("Rendering files into memory for includes ...")
-        for src_file in src_files:
-            content = self.context["src"][src_file]
-            if content.startswith("!norender"):
-                logger.info(f"Rendering {src_file} as-is because of !norender")
-                self.no_render_files.add(src_file)
-                self.context["src"][src_file] = self.strip_norender_marker(content)
-            else:
-                rendered_content = self.render_template(src_file, lib_content)
-                self.context["src"][src_file] = rendered_content
+    def render_files(self):
+        src_files = self.load_sources()
+        manifest = BuildManifest.load(self.state_folder, self.build_folder, self.src_folder, self.render_settings())
+        if not self.incremental:
+            manifest.files.clear()
+
+        for src_file in set(manifest.files) - set(src_files):
+            logger.info(f"{src_file} was removed from {self.src_folder}")
+            self.remove_outputs(manifest.forget(src_file))
+
+        dirty = manifest.dirty_files(src_files)
+        logger.info(f"{len(dirty)} of {len(src_files)} file(s) need rendering")
+
+        copies = [src_file for src_file in src_files if src_file in dirty and src_file in self.passthrough]
+        with profiling.span("passthrough", "build", files=len(copies)):
+            self.copy_passthrough(copies, manifest)
 
         logger.info("Rendering files onto disk...")
-        for src_file in src_files:
-            content = self.context["src"][src_file]
-            if src_file in self.no_render_files:
-                logger.info(f"Rendering {src_file} as-is because of !norender")
-                rendered_content = content
+        todo = [src_file for src_file in src_files if src_file in dirty and src_file not in self.passthrough]
+        processor = OutputProcessor.load(self.build_folder, self.state_folder, self.jobs)
+        rendered, written = set(), []
+        try:
+            for results in self.render_batches(todo, processor):
+                for src_file, outputs, deps in results:
+                    self.remove_outputs(set(manifest.outputs(src_file)) - set(outputs))
+                    manifest.record(src_file, deps, outputs)
+                    rendered.add(src_file)
+                    written.extend(outputs)
+        except Exception:
+            # Keep what did render; the rest may share inputs recorded above, so mark it dirty
+            for src_file in todo:
+                if src_file not in rendered:
+                    manifest.invalidate(src_file)
+            manifest.save()
+            raise
+
+        manifest.save()
+
+        if self.fingerprint:
+            AssetManifest.load(self.build_folder).fingerprint()
+        elif (manifest.previous_settings or {}).get("fingerprint"):
+            # Pages rendered without --fingerprint don't reference the copies anymore
+            AssetManifest.load(self.build_folder).remove()
+        if self.precompress:
+            processor.compress()
+        # What this build rendered, passthrough copies aside
+        return written
+
+    def render_batches(self, todo, processor):
+        # Yield the (src_file, outputs, deps) of each batch once it is rendered and minified
+        if self.fingerprint:
+            # Assets first, pages hash what they reference through _o_["asset"]
+            assets = [src_file for src_file in todo if fingerprintable(src_file)]
+            batches = [assets, [src_file for src_file in todo if src_file not in assets]]
+        else:
+            batches = [todo]
+
+        for batch in batches:
+            if self.jobs > 1 and (len(batch) > 1 or any(f in self.collections for f in batch)):
+                results = self.build_files_in_parallel(batch)
             else:
-                logger.info(f"Rendering {src_file}")
-                rendered_content = self.render_template(src_file, lib_content)
+                results = ((f, self.build_file(f), self.dependencies.get(f, set())) for f in batch)
 
-            sections, pure_html = self.parse_special_tags(rendered_content)
+            done, error = [], None
+            try:
+                for src_file, outputs, deps in results:
+                    if len(set(outputs)) < len(outputs):
+                        logger.warning(f"{src_file} wrote {len(outputs) - len(set(outputs))} page(s) over another one")
+                    done.append((src_file, outputs, deps))
+            except Exception as e:
+                # The files rendered before the failure are still handed back
+                error = e
 
-            if len(sections):
-                logger.info(f"Processing {len(sections)} found in {src_file}")
-                self.process_sections(sections)
+            # Before the next batch, so fingerprints are taken of the minified assets
+            if self.minify:
+                processor.minify([output for _, outputs, _ in done for output in outputs])
+            yield done
+            if error is not None:
+                raise error
 
-            if not pure_html.strip():
-                logger.warning(f"Not rendering {src_file} as its final content is empty")
-                continue
+    def copy_passthrough(self, src_files, manifest):
+        # Straight file to file in the kernel (reflink, copy_file_range or sendfile)
+        if src_files:
+            logger.info(f"Copying {len(src_files)} passthrough file(s)")
+        for src_file in src_files:
+            fast_copy(os.path.join(self.src_folder, src_file), os.path.join(self.build_folder, src_file))
+            logger.info(f"Copied {src_file} as-is")
+            self.remove_outputs(set(manifest.outputs(src_file)) - {src_file})
+            manifest.record(src_file, set(), [src_file])
+
+    def render_settings(self):
+        # Settings that change what rendering writes, outputs of other settings are stale
+        return {"minify": self.minify, "fingerprint": self.fingerprint, "passthrough": list(self.passthrough_patterns)}
+
+    def build_id(self):
+        # Runners building the same src tree with the same settings agree on it
+        settings = {**self.render_settings(), "media": self.optimizer.settings()}
+        return tree_digest(self.src_folder, settings)
+
+    def action_key(self, src_file):
+        index, count = self.shard if src_file in self.collections else (0, 1)
+        return ArtifactCache.action_key(src_file, index, count, self.minify, self.fingerprint)
+
+    def restore_render(self, src_file, fingerprints):
+        # Outputs another run rendered from the same inputs, None if there are none
+        action = self.artifacts.load_action(self.action_key(src_file))
+        if action is None:
+            return None
+        for dep, digest in action["deps"].items():
+            fingerprint = fingerprints.fingerprint(dep)
+            if fingerprint is None or fingerprint.get("hash") != digest:
+                return None
+        if not all(self.artifacts.has(digest) for digest in action["outputs"].values()):
+            return None
 
-            # Construct full path for build file
-            build_file_path = os.path.join(self.build_folder, src_file)
-            os.makedirs(os.path.dirname(build_file_path), exist_ok=True)
-            with open(build_file_path, "w") as build_file:
-                build_file.write(pure_html)
-                logger.info(f"Wrote {build_file.name}")
-
-        logger.info("Copying media files ...")
-        media_destination = os.path.join(self.build_folder, self.media_folder)
-        self.copy_files(self.media_folder, media_destination)
-        self.optimizer.optimize(media_destination)
+        # Pages hash the assets they reference, those have to be on disk
+        if self.fingerprint and fingerprintable(src_file):
+            for output, digest in action["outputs"].items():
+                self.artifacts.restore(digest, os.path.join(self.build_folder, output))
+        logger.info(f"Reusing {len(action['outputs'])} output(s) of {src_file} from the artifact cache")
+        return {"deps": sorted(action["deps"]), "outputs": action["outputs"]}
+
+    def store_render(self, src_file, outputs, deps, fingerprints):
+        # Publish a render's outputs, and the hashes of its inputs and of those of
+        # the src files it includes, unless a plugin makes them unknowable
+        stored = {output: self.artifacts.store(os.path.join(self.build_folder, output)) for output in outputs}
+        deps = set(deps) | {f"src:{src_file}"}
+        closure = set(deps)
+        for included in self.included_files(src_file) - {src_file}:
+            closure |= self.dependencies.get(included, set())
+        hashes = {dep: fingerprints.fingerprint(dep) for dep in closure}
+        if all(fingerprint is not None for fingerprint in hashes.values()):
+            action = {"deps": {dep: fingerprint["hash"] for dep, fingerprint in hashes.items()}, "outputs": stored}
+            self.artifacts.save_action(self.action_key(src_file), action)
+        return {"deps": sorted(deps), "outputs": stored}
+
+    def process_shard(self, media_only=False):
+        with profiling.span("process_media", "build"):
+            self.optimize_media_share()
+            if not media_only:
+                # Images of other shards come from the media cache once they published them
+                self.process_media()
+        if not media_only:
+            with profiling.span("render_shard", "build"):
+                self.render_shard()
         logger.info("All done")
 
-    def process_sections(self, sections):
-        for section in sections:
-            section_type = section["opening_tag"]["type"]
-            if section_type == "start_page":
-                page_name = section["opening_tag"]["page_name"] + ".html"
-                build_file_path = os.path.join(self.build_folder, page_name)
-                os.makedirs(os.path.dirname(build_file_path), exist_ok=True)
-                with open(build_file_path, "w") as build_file:
-                    build_file.write(section["_content"])
-                    logger.info(f"Wrote {build_file.name} from section")
+    def optimize_media_share(self):
+        # Optimize this shard's share of the media into the shared media cache
+        index, count = self.shard
+        share = []
+        for root, _, names in os.walk(self.media_folder):
+            for name in names:
+                relative_path = os.path.relpath(os.path.join(root, name), self.media_folder)
+                if shard_of(relative_path, count) == index and self.optimizer.optimizable(relative_path):
+                    share.append(relative_path)
+        logger.info(f"Shard {index}/{count}: optimizing {len(share)} media file(s) into the media cache")
+        if not share:
+            return
 
-    def parse_special_tags(self, html_str):
-        tag_pattern = re.compile(r"\[---\s*(\S+?)\s*--\s*(\{.*\})\s*\]")
-        sections, cleaned_html, stack, content_stack = [], [], [], []
-
-        for line in html_str.splitlines():
-            tag_match = tag_pattern.search(line)
-            if tag_match:
-                json_data = json.loads(tag_match.group(2))
-                if stack:
-                    last_section = stack.pop()
-                    section = {
-                        **last_section,
-                        "closing_tag": json_data,
-                        "_content": "\n".join(content_stack.pop()).strip(),
-                    }
-                    sections.append(section)
+        os.makedirs(self.state_folder, exist_ok=True)
+        with tempfile.TemporaryDirectory(prefix="shard-media-", dir=self.state_folder) as tmp:
+            paths = []
+            for relative_path in share:
+                paths.append(os.path.join(tmp, relative_path))
+                fast_copy(os.path.join(self.media_folder, relative_path), paths[-1])
+            self.optimizer.optimize_files(paths)
+
+    def render_shard(self):
+        index, count = self.shard
+        src_files = self.load_sources()
+        build_id = self.build_id()
+
+        # Collections are split between every shard, other files go to one. With
+        # --fingerprint every shard renders the assets, as pages need their hashes.
+        owned = [
+            src_file
+            for src_file in src_files
+            if src_file in self.collections
+            or shard_of(src_file, count) == index
+            or (self.fingerprint and fingerprintable(src_file))
+        ]
+        logger.info(f"Shard {index}/{count} of build {build_id[:12]}: {len(owned)} of {len(src_files)} file(s)")
+
+        files = {}
+        for src_file in owned:
+            if src_file in self.passthrough:
+                digest = self.artifacts.store(os.path.join(self.src_folder, src_file))
+                files[src_file] = {"deps": [f"src:{src_file}"], "outputs": {src_file: digest}}
+
+        todo = [src_file for src_file in owned if src_file not in self.passthrough]
+        if self.fingerprint:
+            assets = [src_file for src_file in todo if fingerprintable(src_file)]
+            groups = [assets, [src_file for src_file in todo if src_file not in assets]]
+        else:
+            groups = [todo]
+
+        processor = OutputProcessor.load(self.build_folder, self.state_folder, self.jobs)
+        reused = 0
+        for group in groups:
+            fingerprints = BuildManifest(self.state_folder, self.build_folder, self.src_folder)
+            rendering = []
+            for src_file in group:
+                entry = self.restore_render(src_file, fingerprints)
+                if entry is None:
+                    rendering.append(src_file)
                 else:
-                    stack.append({"opening_tag": json_data})
-                    content_stack.append([])
-            elif stack:
-                content_stack[-1].append(line)
-            else:
-                cleaned_html.append(line)
+                    files[src_file] = entry
+                    reused += 1
 
-        if stack:
-            logger.critical(f"Found unclosed section: \n{content_stack[-1]}")
-            raise Exception("Found unclosed section.")
+            for results in self.render_batches(rendering, processor):
+                fingerprints = BuildManifest(self.state_folder, self.build_folder, self.src_folder)
+                for src_file, outputs, deps in results:
+                    files[src_file] = self.store_render(src_file, outputs, deps, fingerprints)
 
-        return sections, "\n".join(cleaned_html)
+        self.artifacts.save_shard(build_id, index, count, files)
+        logger.info(
+            f"Shard {index}/{count}: published {sum(len(entry['outputs']) for entry in files.values())} output(s), "
+            f"{reused} of {len(todo)} render(s) reused from the artifact cache"
+        )
+
+    def merge_shards(self, count):
+        # Assemble build/ from what the shards published, refusing anything incomplete
+        with profiling.span("process_media", "build"):
+            self.process_media()
+
+        with profiling.span("merge", "build"):
+            src_files = self.load_sources()
+            build_id = self.build_id()
+            shards = [self.artifacts.load_shard(build_id, index, count) for index in range(count)]
+            missing = [str(index) for index, shard in enumerate(shards) if shard is None]
+            if missing:
+                raise RuntimeError(
+                    f"Shard(s) {', '.join(missing)} of {count} were not built for this src tree (build {build_id[:12]})"
+                )
+
+            files, outputs, problems = {}, {}, []
+            for index, shard in enumerate(shards):
+                for src_file, entry in shard["files"].items():
+                    merged = files.setdefault(src_file, {"deps": set(), "outputs": set(), "shards": set()})
+                    merged["deps"].update(entry["deps"])
+                    merged["outputs"].update(entry["outputs"])
+                    merged["shards"].add(index)
+                    for output, digest in entry["outputs"].items():
+                        if outputs.setdefault(output, digest) != digest:
+                            problems.append(f"{output} differs between shards")
+
+            for src_file in src_files:
+                expected = set(range(count)) if src_file in self.collections else {shard_of(src_file, count)}
+                found = files.get(src_file, {}).get("shards", set())
+                if not expected <= found:
+                    problems.append(f"{src_file} is missing from shard(s) {', '.join(map(str, sorted(expected - found)))}")
+            for output, digest in sorted(outputs.items()):
+                if not self.artifacts.has(digest):
+                    problems.append(f"{output} is missing from the artifact cache")
+            if problems:
+                for problem in problems:
+                    logger.error(problem)
+                raise RuntimeError(f"Merging {count} shard(s) failed with {len(problems)} problem(s)")
+
+            manifest = BuildManifest.load(self.state_folder, self.build_folder, self.src_folder, self.render_settings())
+            for src_file in set(manifest.files) - set(src_files):
+                logger.info(f"{src_file} was removed from {self.src_folder}")
+                self.remove_outputs(manifest.forget(src_file))
+            for src_file in src_files:
+                self.remove_outputs(set(manifest.outputs(src_file)) - files[src_file]["outputs"])
+
+            restored = 0
+            for output, digest in sorted(outputs.items()):
+                path = os.path.join(self.build_folder, output)
+                if not os.path.exists(path) or file_hash(path) != digest:
+                    self.artifacts.restore(digest, path)
+                    restored += 1
+            for src_file in src_files:
+                manifest.record(src_file, files[src_file]["deps"], files[src_file]["outputs"])
+            manifest.save()
+            logger.info(
+                f"Merged {count} shard(s): {len(outputs)} output(s) of {len(src_files)} file(s) verified, "
+                f"{restored} written"
+            )
+
+        if self.fingerprint:
+            AssetManifest.load(self.build_folder).fingerprint()
+        elif (manifest.previous_settings or {}).get("fingerprint"):
+            # Pages rendered without --fingerprint don't reference the copies anymore
+            AssetManifest.load(self.build_folder).remove()
+        if self.precompress:
+            OutputProcessor.load(self.build_folder, self.state_folder, self.jobs).compress()
+        logger.info("All done")
+
+    def process_media(self):
+        logger.info("Syncing media files ...")
+        media_destination = os.path.join(self.build_folder, self.media_name)
+        has_media = any(files for _, _, files in os.walk(self.media_folder))
+        if not has_media and not os.path.exists(os.path.join(self.build_folder, MediaSync.filename)):
+            logger.info("No media files")
+            return
+        media_sync = MediaSync(self.media_folder, media_destination, self.state_folder, self.optimizer.settings())
+        changed = media_sync.sync(optimizable=self.optimizer.optimizable)
+
+        outputs = {result["path"]: result["outputs"] for result in self.optimizer.optimize_files(changed)}
+        for path in changed:
+            media_sync.record_outputs(path, outputs.get(path, []))
+        media_sync.save()
+
+        # Only written when some image has variants, and rewritten when they change
+        variants = VariantManifest.load(media_destination)
+        variants_changed = False
+        for relative_path in set(variants.images) - set(media_sync.files):
+            variants_changed |= variants.remove(relative_path)
+        for path in changed:
+            variants_changed |= variants.update(path, outputs.get(path, []))
+        if variants.images:
+            if variants_changed or not os.path.exists(variants.path):
+                variants.save()
+        elif os.path.exists(variants.path):
+            os.remove(variants.path)
 
+        index = MediaIndex.load(media_destination, self.state_folder)
+        if index.update(media_sync.files) or not os.path.exists(index.path):
+            index.save()
+        index.save_stamps()
+
+    def write_section(self, section):
+        if section["opening_tag"]["type"] != "start_page":
+            return None
+        page_name = section["opening_tag"]["page_name"] + ".html"
+        build_file_path = os.path.join(self.build_folder, page_name)
+        os.makedirs(os.path.dirname(build_file_path), exist_ok=True)
+        with open(build_file_path, "w") as build_file:
+            build_file.write(section["_content"])
+            logger.info(f"Wrote {build_file.name} from section")
+        return page_name
+
+    def process_sections(self, sections):
+        written = [self.write_section(section) for section in sections]
+        return [page_name for page_name in written if page_name]
+
+    def parse_special_tags(self, html_str):
+        # Whole-string counterpart of the streaming scanner used by build_file
+        sections, cleaned_html = [], []
+        scanner = SectionScanner(cleaned_html.extend, sections.append)
+        scanner.feed(html_str)
+        scanner.close()
+        return sections, "\n".join(cleaned_html)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -183,10 +781,196 @@ if __name__ == "__main__":
         dest="source_from_git_repo",
         help="Sparse checkout src/ and media/ from a git repo before building",
     )
+    parser.add_argument(
+        "--git-cache",
+        dest="git_cache",
+        help="Keep a mirror of --source-from-git-repo here and only fetch and sync what changed",
+    )
+    parser.add_argument(
+        "--git-ref",
+        dest="git_ref",
+        default="HEAD",
+        help="Branch, tag or commit of --source-from-git-repo to build (needs --git-cache unless HEAD)",
+    )
+    parser.add_argument(
+        "--build-from-checkout",
+        dest="build_from_checkout",
+        action="store_true",
+        help="Read src/ and media/ straight from the --git-cache mirror instead of copying them",
+    )
+    parser.add_argument(
+        "--bytecode-cache",
+        dest="bytecode_cache",
+        help="Directory where compiled templates are cached across builds",
+    )
+    parser.add_argument(
+        "--state-dir",
+        dest="state_dir",
+        default=".cache/jinjapocalypse",
+        help="Directory where incremental builds keep their state, outside the published build folder",
+    )
+    parser.add_argument(
+        "--media-cache",
+        dest="media_cache",
+        help="Directory where optimized media are cached across builds",
+    )
+    parser.add_argument(
+        "--media-memory-mb",
+        dest="media_memory_mb",
+        type=int,
+        help="Estimated memory ceiling for images optimized at once with --jobs",
+    )
+    parser.add_argument(
+        "--media-max-megapixels",
+        dest="media_max_megapixels",
+        type=float,
+        help="Scale bigger images down to this many megapixels before optimizing them",
+    )
+    parser.add_argument(
+        "--responsive-widths",
+        dest="responsive_widths",
+        default="",
+        help="Comma-separated widths of the WebP/AVIF variants written next to each image, e.g. 480,960,1600",
+    )
+    parser.add_argument(
+        "--full-rebuild",
+        dest="full_rebuild",
+        action="store_true",
+        help="Ignore the build manifest and re-render every file",
+    )
+    parser.add_argument(
+        "--fingerprint",
+        action="store_true",
+        help="Also write static files under content-hashed names, listed in build/assets.json",
+    )
+    parser.add_argument(
+        "--passthrough",
+        action="append",
+        default=[],
+        metavar="GLOB",
+        help="Copy src files matching GLOB as-is instead of rendering them (repeatable); "
+        "binary files, fonts, images and *.min.js/*.min.css/*.map always are",
+    )
+    parser.add_argument(
+        "--minify",
+        action="store_true",
+        help="Minify the HTML, CSS and JS written by rendering",
+    )
+    parser.add_argument(
+        "--precompress",
+        action="store_true",
+        help="Keep .gz (and .zst with the zstandard module) copies of text files in build/ for the web server",
+    )
+    parser.add_argument(
+        "--artifact-cache",
+        dest="artifact_cache",
+        help="Shared directory where --shard runs publish their outputs and --merge collects them",
+    )
+    parser.add_argument(
+        "--shard",
+        metavar="I/N",
+        help="Only optimize and render shard I (from 0) of N of the build, publishing to --artifact-cache",
+    )
+    parser.add_argument(
+        "--media-only",
+        dest="media_only",
+        action="store_true",
+        help="With --shard, only optimize the shard's share of the media into the artifact cache",
+    )
+    parser.add_argument(
+        "--merge",
+        type=int,
+        metavar="N",
+        help="Assemble build/ from the N shards published to --artifact-cache and check nothing is missing",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes used to render files and optimize media (0 = one per CPU)",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running, rebuild on changes and serve build/ over HTTP",
+    )
+    parser.add_argument("--serve-host", dest="serve_host", default="127.0.0.1", help="Address the --watch server binds to")
+    parser.add_argument("--serve-port", dest="serve_port", type=int, default=8000, help="Port the --watch server listens on")
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="profile",
+        help="Record build timings, write PROFILE.json and PROFILE.trace.json (default: profile)",
+    )
+    parser.add_argument(
+        "--profile-top",
+        dest="profile_top",
+        type=int,
+        default=10,
+        help="Number of slowest events listed at the end of a --profile build",
+    )
     args = parser.parse_args()
 
+    shard = None
+    if args.shard or args.merge:
+        if not args.artifact_cache:
+            parser.error("--shard and --merge need --artifact-cache")
+        if args.shard and args.merge:
+            parser.error("--shard and --merge are separate steps")
+        if args.watch:
+            parser.error("--watch can't be used with --shard or --merge")
+    if args.shard:
+        try:
+            shard = parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+    elif args.media_only:
+        parser.error("--media-only needs --shard")
+    if args.merge is not None and args.merge < 1:
+        parser.error("--merge needs a number of shards")
+
+    if args.profile:
+        profiling.enable()
+
+    folders = {}
     if args.source_from_git_repo:
-        GitRepoSource(args.source_from_git_repo).copy_source_tree(".")
+        if (args.build_from_checkout or args.git_ref != "HEAD") and not args.git_cache:
+            parser.error("--build-from-checkout and --git-ref need --git-cache")
+        git_source = GitRepoSource(args.source_from_git_repo, cache_dir=args.git_cache, ref=args.git_ref)
+        if args.build_from_checkout:
+            checkout = git_source.checkout_path()
+            folders = {"src_folder": str(checkout / "src"), "media_folder": str(checkout / "media")}
+        else:
+            git_source.copy_source_tree(".")
+
+    jinjapocalypse_instance = Jinjapocalypse(
+        **folders,
+        bytecode_cache=args.bytecode_cache,
+        state_folder=args.state_dir,
+        incremental=not args.full_rebuild,
+        jobs=args.jobs,
+        media_cache=args.media_cache,
+        media_memory_mb=args.media_memory_mb,
+        media_max_megapixels=args.media_max_megapixels,
+        responsive_widths=[int(w) for w in args.responsive_widths.split(",") if w.strip()],
+        fingerprint=args.fingerprint,
+        passthrough=args.passthrough,
+        minify=args.minify,
+        precompress=args.precompress,
+        shard=shard,
+        artifact_cache=args.artifact_cache,
+    )
+    if shard is not None:
+        jinjapocalypse_instance.process_shard(media_only=args.media_only)
+    elif args.merge:
+        jinjapocalypse_instance.merge_shards(args.merge)
+    else:
+        jinjapocalypse_instance.process_files()
+
+    if args.profile:
+        profiling.report(args.profile, top=args.profile_top)
+
+    if args.watch:
+        from watch import watch
 
-    jinjapocalypse_instance = Jinjapocalypse()
-    jinjapocalypse_instance.process_files()
+        watch(jinjapocalypse_instance, host=args.serve_host, port=args.serve_port)
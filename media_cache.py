@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from loguru import logger
+
+from incremental import file_hash
+from sync import fast_copy
+
+
+class MediaCache:
+    """
+    Content-addressed store for optimized media.
+
+    An entry is keyed by the hash of a source image plus the optimizer settings
+    and holds every file the optimizer wrote for that source. Files are named
+    after what follows the source's base name (`.jpg` for `photo.png` ->
+    `photo.jpg`), so an entry can be restored next to any file with the same
+    content. Entries are evicted by age and, oldest first, by total size.
+    """
+
+    def __init__(self, folder, max_bytes=None, max_age_seconds=None):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        os.makedirs(folder, exist_ok=True)
+
+    def key(self, source_path, settings):
+        digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8"))
+        digest.update(file_hash(source_path).encode("ascii"))
+        return digest.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.folder, key[:2], key)
+
+    def restore(self, key, source_path):
+        """Copy a cached entry next to source_path, return the restored paths or None on a miss."""
+        entry = self._entry(key)
+        if not os.path.isdir(entry):
+            return None
+
+        base = os.path.splitext(source_path)[0]
+        restored = []
+        for name in sorted(os.listdir(entry)):
+            restored.append(base + name[len("out"):])
+            fast_copy(os.path.join(entry, name), restored[-1])
+        os.utime(entry)
+        return restored
+
+    def store(self, key, source_path, outputs):
+        entry = self._entry(key)
+        base = os.path.splitext(source_path)[0]
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+
+        tmp_entry = tempfile.mkdtemp(prefix=".tmp-", dir=os.path.dirname(entry))
+        try:
+            for output in outputs:
+                if not output.startswith(base):
+                    logger.warning(f"Not caching {output}, it is not named after {source_path}")
+                    continue
+                shutil.copyfile(output, os.path.join(tmp_entry, "out" + output[len(base):]))
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # Another build stored the same entry first
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+    def evict(self):
+        entries = []
+        for shard in os.listdir(self.folder):
+            shard_path = os.path.join(self.folder, shard)
+            if not os.path.isdir(shard_path):
+                continue
+            for key in os.listdir(shard_path):
+                if key.startswith(".tmp-"):
+                    continue
+                entry = os.path.join(shard_path, key)
+                size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        removed = 0
+        for mtime, size, entry in entries:
+            too_old = self.max_age_seconds is not None and now - mtime > self.max_age_seconds
+            too_big = self.max_bytes is not None and total > self.max_bytes
+            if not (too_old or too_big):
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            removed += 1
+
+        if removed:
+            logger.info(f"Evicted {removed} media cache entr{'y' if removed == 1 else 'ies'} ({total // 1024} KB kept)")
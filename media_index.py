@@ -0,0 +1,135 @@
+import json
+import os
+
+from loguru import logger
+
+from incremental import file_hash
+
+# Side of the thumbnail the dominant color is taken from
+COLOR_SAMPLE = 64
+
+
+def _dominant_color(im):
+    """Most common color of a small, palette-reduced copy of im's opaque pixels, as #rrggbb."""
+    # Shrink first (JPEGs decode straight at 1/8 of their size), only the thumbnail is converted
+    im.draft("RGB", (COLOR_SAMPLE, COLOR_SAMPLE))
+    im.thumbnail((COLOR_SAMPLE, COLOR_SAMPLE))
+    sample = im.convert("RGBA")
+    quantized = sample.convert("RGB").quantize(colors=8)
+    counts = [0] * 256
+    for index, alpha in zip(quantized.getdata(), sample.getchannel("A").getdata()):
+        if alpha >= 128:
+            counts[index] += 1
+    if not any(counts):
+        return None
+    index = counts.index(max(counts))
+    return "#{:02x}{:02x}{:02x}".format(*quantized.getpalette()[index * 3:index * 3 + 3])
+
+
+def describe(path):
+    """
+    Metadata of one media file. Dimensions and format come from the image
+    header; only the dominant color needs pixels, which JPEGs decode at a
+    fraction of their size (draft mode).
+    """
+    entry = {
+        "size": os.path.getsize(path),
+        "hash": file_hash(path),
+        "format": None,
+        "width": None,
+        "height": None,
+        "color": None,
+    }
+
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        with Image.open(path) as im:
+            entry.update(format=(im.format or "").lower() or None, width=im.width, height=im.height)
+            entry["color"] = _dominant_color(im)
+    except UnidentifiedImageError:
+        entry["format"] = os.path.splitext(path)[1].lstrip(".").lower() or None
+    except OSError as e:
+        logger.warning(f"Could not read image metadata of {path}: {e}")
+    return entry
+
+
+class MediaIndex:
+    """
+    Metadata of every published media file, keyed by path relative to the
+    media folder, for templates to read without opening images:
+
+        {"photo.jpg": {"width": 1200, "height": 900, "format": "jpeg", "size": 181233,
+                       "color": "#a0522d", "hash": "9f86d0..."}}
+
+    Entries are refreshed when the file's size or mtime changes. Those stamps
+    differ between checkouts, so they are kept apart in state_folder: the
+    published index only changes with the media themselves.
+    """
+
+    filename = "media-index.json"
+    stamps_filename = "media-index-stamps.json"
+
+    def __init__(self, media_build_folder, state_folder=None):
+        self.folder = media_build_folder
+        self.path = os.path.join(media_build_folder, self.filename)
+        self.stamps_path = os.path.join(state_folder, self.stamps_filename) if state_folder else None
+        self.files = {}
+        self.stamps = {}
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable media index {path}: {e}")
+        return {}
+
+    @classmethod
+    def load(cls, media_build_folder, state_folder=None):
+        index = cls(media_build_folder, state_folder)
+        index.files = cls._read(index.path)
+        if index.stamps_path:
+            index.stamps = cls._read(index.stamps_path)
+        return index
+
+    @staticmethod
+    def _write(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    def save(self):
+        self._write(self.path, self.files)
+
+    def save_stamps(self):
+        self._write(self.stamps_path, self.stamps)
+
+    def update(self, relative_paths):
+        """
+        Index relative_paths, reading only new and changed files, and forget
+        every other file. Returns whether the published index changed.
+        """
+        current, stamps, refreshed = {}, {}, 0
+        for relative_path in sorted(relative_paths):
+            path = os.path.join(self.folder, relative_path)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entry = self.files.get(relative_path)
+            stamps[relative_path] = [st.st_size, st.st_mtime_ns]
+            if entry is None or self.stamps.get(relative_path) != stamps[relative_path]:
+                entry = describe(path)
+                refreshed += 1
+            current[relative_path] = entry
+
+        changed = current != self.files
+        self.files, self.stamps = current, stamps
+        logger.info(f"Media index: {refreshed} of {len(current)} file(s) read")
+        return changed
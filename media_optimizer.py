@@ -1,10 +1,56 @@
+import multiprocessing
 import os
+import functools
 import io
-from math import ceil
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from math import sqrt
 from typing import Optional
-from PIL import Image, ImageOps, ImageChops
+from PIL import Image, ImageOps, ImageChops, ImageMath, features
 from loguru import logger
 
+import profiling
+from media_cache import MediaCache
+
+# Bump when the optimization code changes output, to invalidate cached media.
+ALGORITHM_VERSION = 5
+
+_WORKER = None
+
+
+def _init_worker(optimizer):
+    global _WORKER
+    _WORKER = optimizer
+    profiling.drain()
+
+
+def _optimize_in_worker(path, method):
+    return _WORKER._optimize_one(path, method), profiling.drain()
+
+
+def _profiled(name):
+    """Record an encoder call with the encodes it spent and the bytes it produced."""
+
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, img, *args, **kwargs):
+            if not profiling.enabled():
+                return method(self, img, *args, **kwargs)
+            encodes, written = self.encodes, len(self._written or [])
+            with profiling.span(name, "media", size=list(img.size)) as info:
+                result = method(self, img, *args, **kwargs)
+                info["encodes"] = self.encodes - encodes
+                if isinstance(result, bytes):
+                    info["bytes"] = len(result)
+                else:
+                    info["bytes"] = sum(os.path.getsize(p) for p in (self._written or [])[written:])
+            return result
+
+        return wrapper
+
+    return decorate
+
 
 class MediaOptimizer:
     def __init__(
@@ -15,24 +61,46 @@ class MediaOptimizer:
         min_side_px=64,
         scale_step=0.02,
         max_compression_jpg=85,
-        max_compression_png=9,  # kept for API compatibility; unused in PNG path below
+        jpeg_encode_budget=12,
+        max_compression_png=9,
+        png_encode_budget=8,
         convert_png_to_jpg=True,
         emit_resized_png=True,
         jpg_suffix="",
         png_suffix="",
+        cache_dir=None,
+        cache_max_mb=2048,
+        cache_max_age_days=30,
+        jobs=1,
+        max_memory_mb=None,
+        max_pixels=None,
+        variant_widths=(),
+        variant_formats=("avif", "webp"),
+        variant_quality=70,
     ):
         """
         :param max_size_kb: Size cap per output (KB) for optimization targets.
         :param optimize_png: Whether to process .png inputs at all.
         :param optimize_jpg: Whether to optimize .jpg/.jpeg inputs.
         :param min_side_px: Minimum dimension when downscaling.
-        :param scale_step: Fraction to reduce width/height each iteration (e.g. 0.02 = 2%).
+        :param scale_step: Precision of the downscale search (e.g. 0.02 = 2%).
         :param max_compression_jpg: Lowest JPEG quality we’ll try (e.g. 85).
-        :param max_compression_png: Kept for compatibility; PNG path below avoids _encode_png.
+        :param jpeg_encode_budget: Maximum number of JPEG encodes spent on one image.
+        :param max_compression_png: zlib compression level for PNG outputs (9 also enables optimize).
+        :param png_encode_budget: Maximum number of PNG encodes spent on one image.
         :param convert_png_to_jpg: For PNG inputs, also write an optimized JPEG sibling.
-        :param emit_resized_png: For PNG inputs, also write a resized PNG sibling (no _encode_png).
+        :param emit_resized_png: For PNG inputs, also write an optimized PNG sibling (palette/resized if needed).
         :param jpg_suffix: Suffix for converted JPG (before extension).
         :param png_suffix: Suffix for resized PNG (before extension).
+        :param cache_dir: Folder for the content-addressed cache of optimized outputs (None disables it).
+        :param cache_max_mb: Evict the oldest cache entries beyond this total size.
+        :param cache_max_age_days: Evict cache entries unused for this many days.
+        :param jobs: Number of worker processes optimizing images in parallel.
+        :param max_memory_mb: Estimated memory ceiling for the images being processed at once.
+        :param max_pixels: Images with more pixels are scaled down to this many before anything else.
+        :param variant_widths: Widths of the responsive variants written next to each image (none by default).
+        :param variant_formats: Formats of the responsive variants, those Pillow can't write are skipped.
+        :param variant_quality: Encoder quality for the responsive variants.
         """
         self.max_size = max_size_kb * 1024
         self.optimize_png = optimize_png
@@ -40,7 +108,9 @@ class MediaOptimizer:
         self.min_side_px = int(min_side_px)
         self.scale_step = float(scale_step)
         self.max_compression_jpg = int(max_compression_jpg)
+        self.jpeg_encode_budget = int(jpeg_encode_budget)
         self.max_compression_png = int(max_compression_png)
+        self.png_encode_budget = int(png_encode_budget)
         self.convert_png_to_jpg = bool(convert_png_to_jpg)
         self.emit_resized_png = bool(emit_resized_png)
         self.jpg_suffix = str(jpg_suffix)
@@ -51,45 +121,267 @@ class MediaOptimizer:
         if self.jpg_qualities[-1] != self.max_compression_jpg:
             self.jpg_qualities.append(self.max_compression_jpg)
 
-    def optimize(self, media_folder: str):
+        self.cache = None
+        if cache_dir:
+            self.cache = MediaCache(
+                cache_dir,
+                max_bytes=cache_max_mb * 1024 * 1024 if cache_max_mb else None,
+                max_age_seconds=cache_max_age_days * 86400 if cache_max_age_days else None,
+            )
+        self.variant_widths = sorted(int(w) for w in variant_widths)
+        self.variant_formats = [f for f in variant_formats if features.check(f)]
+        for f in set(variant_formats) - set(self.variant_formats):
+            logger.warning(f"Pillow can't write {f}, skipping {f} variants")
+        self.variant_quality = int(variant_quality)
+        self.jobs = max(1, int(jobs))
+        self.max_memory_mb = max_memory_mb
+        self.max_pixels = int(max_pixels) if max_pixels else None
+        self._written = None
+        self.encodes = 0
+
+    def settings(self) -> dict:
+        """Everything that affects the optimizer output."""
+        return {
+            "algorithm": ALGORITHM_VERSION,
+            "max_size": self.max_size,
+            "min_side_px": self.min_side_px,
+            "scale_step": self.scale_step,
+            "jpg_qualities": self.jpg_qualities,
+            "jpeg_encode_budget": self.jpeg_encode_budget,
+            "max_compression_png": self.max_compression_png,
+            "png_encode_budget": self.png_encode_budget,
+            "convert_png_to_jpg": self.convert_png_to_jpg,
+            "emit_resized_png": self.emit_resized_png,
+            "max_pixels": self.max_pixels,
+            "jpg_suffix": self.jpg_suffix,
+            "png_suffix": self.png_suffix,
+            "variant_widths": self.variant_widths,
+            "variant_formats": self.variant_formats,
+            "variant_quality": self.variant_quality,
+        }
+
+    def _process_cached(self, filepath: str, process) -> bool:
+        """
+        Run process(filepath) unless the cache already holds its outputs for
+        this content and these settings, in which case they are copied in place.
+        Returns whether the outputs came from the cache.
+        """
+        if self.cache is None:
+            process(filepath)
+            return False
+
+        key = self.cache.key(filepath, self.settings())
+        restored = self.cache.restore(key, filepath)
+        if restored is not None:
+            logger.debug(f"Restored {os.path.basename(filepath)} from media cache")
+            self._written.extend(restored)
+            return True
+
+        if process(filepath):
+            self.cache.store(key, filepath, self._written)
+        return False
+
+    def _optimize_one(self, filepath: str, method: str) -> dict:
+        started = time.perf_counter()
+        encodes = self.encodes
+        before = os.path.getsize(filepath)
+
+        self._written = []
+        try:
+            cached = self._process_cached(filepath, getattr(self, method))
+            written = sorted(set(self._written))
+        finally:
+            self._written = None
+
+        summary = {
+            "path": filepath,
+            "before": before,
+            "after": sum(os.path.getsize(p) for p in written) if written else before,
+            "outputs": written,
+            "seconds": time.perf_counter() - started,
+            "encodes": self.encodes - encodes,
+            "cached": cached,
+        }
+        profiling.add(
+            "optimize", "media", started, summary["seconds"],
+            path=filepath, before=before, after=summary["after"], encodes=summary["encodes"], cached=cached,
+        )
+        return summary
+
+    def _estimate_memory(self, filepath: str) -> int:
+        """Rough peak memory to process an image, from its header only."""
+        try:
+            with Image.open(filepath) as im:
+                w, h = im.size
+                bands = len(im.getbands())
+                scale = self._decode_scale(im, os.path.getsize(filepath))
+                # draft mode decodes JPEGs at the first of 1/8, 1/4, 1/2 at or above scale
+                decoded = next(d for d in (1 / 8, 1 / 4, 1 / 2, 1) if d >= scale) if im.format == "JPEG" else 1
+        except Exception:
+            return 0
+        # the decoded image, then the scaled one and two working copies alive at once
+        return int(w * h * (decoded**2 * bands + scale**2 * max(bands, 3) * 3))
+
+    def optimize(self, media_folder: str) -> list:
+        """
+        Optimize every image under media_folder, with up to `jobs` worker processes
+        whose images together are estimated to fit in `max_memory_mb`. Returns one
+        summary dict per image, sorted by path.
+        """
         logger.info(f"Optimizing media files in: {media_folder}")
-        count = 0
-        for root, _, files in os.walk(media_folder):
-            for name in files:
-                full = os.path.join(root, name)
-                ext = os.path.splitext(name)[1].lower()
-
-                if ext in (".jpg", ".jpeg"):
-                    if not self.optimize_jpg:
-                        logger.debug(f"Skip JPG: {full}")
-                        continue
-                    count += 1
-                    self._optimize_jpeg_inplace(full)
-
-                elif ext == ".png":
-                    if not self.optimize_png:
-                        logger.debug(f"Skip PNG: {full}")
-                        continue
-                    count += 1
-                    self._process_png(full)
-
-        logger.info(f"Media optimization complete. Touched {count} image(s).")
+        paths = [os.path.join(root, name) for root, _, files in os.walk(media_folder) for name in files]
+        return self.optimize_files(paths)
+
+    def optimizable(self, path: str) -> bool:
+        ext = os.path.splitext(path)[1].lower()
+        return (ext in (".jpg", ".jpeg") and self.optimize_jpg) or (ext == ".png" and self.optimize_png)
+
+    def optimize_files(self, paths: list) -> list:
+        """Same as optimize, for an explicit list of files."""
+        tasks = []
+        for full in paths:
+            ext = os.path.splitext(full)[1].lower()
+
+            if ext in (".jpg", ".jpeg"):
+                if not self.optimize_jpg:
+                    logger.debug(f"Skip JPG: {full}")
+                    continue
+                tasks.append((full, "_optimize_jpeg_inplace"))
+
+            elif ext == ".png":
+                if not self.optimize_png:
+                    logger.debug(f"Skip PNG: {full}")
+                    continue
+                tasks.append((full, "_process_png"))
+
+        tasks.sort()
+        if self.jobs > 1 and len(tasks) > 1:
+            results = self._optimize_in_parallel(tasks)
+        else:
+            results = [self._optimize_one(path, method) for path, method in tasks]
+        results.sort(key=lambda r: r["path"])
+
+        if self.cache is not None:
+            self.cache.evict()
+        self._log_summary(results)
+        logger.info(f"Media optimization complete. Touched {len(results)} image(s).")
+        return results
+
+    def _optimize_in_parallel(self, tasks) -> list:
+        budget = self.max_memory_mb * 1024 * 1024 if self.max_memory_mb else None
+        pending = deque((path, method, self._estimate_memory(path)) for path, method in tasks)
+        running = {}
+        in_use = 0
+        results = []
+
+        with ProcessPoolExecutor(
+            max_workers=self.jobs,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_worker,
+            initargs=(self,),
+        ) as executor:
+            while pending or running:
+                # Big images wait until enough memory is released; one always runs
+                while pending and len(running) < self.jobs:
+                    path, method, estimate = pending[0]
+                    if running and budget is not None and in_use + estimate > budget:
+                        break
+                    pending.popleft()
+                    running[executor.submit(_optimize_in_worker, path, method)] = estimate
+                    in_use += estimate
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    in_use -= running.pop(future)
+                    result, events = future.result()
+                    results.append(result)
+                    profiling.extend(events)
+        return results
+
+    @staticmethod
+    def _log_summary(results: list):
+        for r in results:
+            source = " (cached)" if r["cached"] else ""
+            logger.info(
+                f"{os.path.basename(r['path'])}: {r['before']//1024} KB → {r['after']//1024} KB "
+                f"in {r['seconds']:.2f}s, {r['encodes']} encode(s){source}"
+            )
+        if results:
+            before = sum(r["before"] for r in results)
+            after = sum(r["after"] for r in results)
+            logger.info(
+                f"Media total: {before//1024} KB → {after//1024} KB "
+                f"in {sum(r['seconds'] for r in results):.2f}s of work, {sum(r['encodes'] for r in results)} encode(s)"
+            )
+
+    # -------------------- decoding --------------------
+
+    def _decode_scale(self, im: Image.Image, file_size: int) -> float:
+        """
+        Scale an image is brought down to before processing: to max_pixels, and
+        for JPEGs over the cap, whose size predicts that of our encodes, to twice
+        the scale the byte ratio implies, so long as it is at most half and every
+        variant width and min_side_px stay within reach.
+        """
+        w, h = im.size
+        scale = 1.0
+        if self.max_pixels and w * h > self.max_pixels:
+            scale = sqrt(self.max_pixels / (w * h))
+        if im.format == "JPEG" and file_size > self.max_size:
+            # either side may end up the width once the EXIF orientation is applied
+            needed = max(
+                2 * sqrt(self.max_size / file_size),
+                max(self.variant_widths, default=0) / min(w, h),
+                self.min_side_px / min(w, h),
+            )
+            if needed <= 0.5:
+                scale = min(scale, needed)
+        return scale
+
+    def _open(self, filepath: str) -> Image.Image:
+        """
+        Decode an image upright and no bigger than _decode_scale allows: JPEGs
+        straight at 1/2, 1/4 or 1/8 of their size (draft mode), then one resize
+        down to max_pixels if still above it. The full-size decode is released
+        before returning, so only one copy of the image is alive at a time.
+        """
+        with Image.open(filepath) as src:
+            scale = self._decode_scale(src, os.path.getsize(filepath))
+            if scale < 1:
+                src.draft(src.mode, (max(1, round(src.width * scale)), max(1, round(src.height * scale))))
+            src.load()
+            im = src
+            pixels = src.width * src.height
+            if self.max_pixels and pixels > self.max_pixels:
+                if im.mode in ("1", "P"):
+                    im = im.convert("RGBA" if "transparency" in im.info else "RGB")
+                ratio = sqrt(self.max_pixels / pixels)
+                size = (max(1, int(im.width * ratio)), max(1, int(im.height * ratio)))
+                im = im.resize(size, Image.LANCZOS, reducing_gap=3.0)
+                logger.debug(f"Scaled {os.path.basename(filepath)} down to {size[0]}x{size[1]} (max_pixels)")
+            return ImageOps.exif_transpose(im)
 
     # -------------------- JPG path (in-place) --------------------
 
     def _optimize_jpeg_inplace(self, filepath: str):
+        im = None
         try:
-            with Image.open(filepath) as im:
-                im = ImageOps.exif_transpose(im)
-                original = self._read_bytes(filepath)
-                best = self._best_jpeg_bytes(im, cap=self.max_size)
-                if best and len(best) < len(original):
-                    self._write(filepath, best)
-                    self._log_gain(filepath, len(original), len(best))
-                else:
-                    logger.debug(f"No smaller JPG for {os.path.basename(filepath)} ({len(original)//1024} KB)")
+            im = self._open(filepath)
+            original = os.path.getsize(filepath)
+            best = self._best_jpeg_bytes(im, cap=self.max_size)
+            if best and len(best) < original:
+                self._write(filepath, best)
+                self._log_gain(filepath, original, len(best))
+            else:
+                logger.debug(f"No smaller JPG for {os.path.basename(filepath)} ({original//1024} KB)")
+            self._emit_variants(im, filepath)
+            return True
         except Exception as e:
             logger.exception(f"Failed to optimize JPG {filepath}: {e}")
+            return False
+        finally:
+            if im is not None:
+                im.close()
 
     # -------------------- PNG path (convert + resized sibling) --------------------
 
@@ -98,81 +390,160 @@ class MediaOptimizer:
         PNG inputs:
         - Keep original PNG untouched.
         - Optionally emit sibling JPEG (optimized, ≤ max_size).
-        - Optionally emit sibling resized PNG (no _encode_png used).
+        - Optionally emit sibling optimized PNG (lossless first, ≤ max_size).
         """
+        im = None
         try:
-            with Image.open(filepath) as im:
-                im = ImageOps.exif_transpose(im)
-                base, _ = os.path.splitext(filepath)
-
-                # 1) Converted JPEG sibling (optimized to cap)
-                if self.convert_png_to_jpg:
-                    jpg_path = f"{base}{self.jpg_suffix}.jpg"
-                    jpg_bytes = self._best_jpeg_bytes(im, cap=self.max_size)
-                    if jpg_bytes:
-                        self._write(jpg_path, jpg_bytes)
-                        logger.info(f"Wrote {os.path.basename(jpg_path)} ({len(jpg_bytes)//1024} KB) from PNG source")
-                    else:
-                        logger.warning(f"Could not produce capped JPEG for {os.path.basename(filepath)}")
-
-                # 2) Resized PNG sibling (bypass _encode_png)
-                if self.emit_resized_png:
-                    png_path = f"{base}{self.png_suffix}.png"
-                    self._emit_resized_png_no_encode(im, png_path)
+            im = self._open(filepath)
+            base, _ = os.path.splitext(filepath)
+
+            # 1) Converted JPEG sibling (optimized to cap)
+            if self.convert_png_to_jpg:
+                jpg_path = f"{base}{self.jpg_suffix}.jpg"
+                jpg_bytes = self._best_jpeg_bytes(im, cap=self.max_size)
+                if jpg_bytes:
+                    self._write(jpg_path, jpg_bytes)
+                    logger.debug(f"Wrote {os.path.basename(jpg_path)} ({len(jpg_bytes)//1024} KB) from PNG source")
+                else:
+                    logger.warning(f"Could not produce capped JPEG for {os.path.basename(filepath)}")
+
+            # 2) Optimized PNG sibling
+            if self.emit_resized_png:
+                png_path = f"{base}{self.png_suffix}.png"
+                self._emit_optimized_png(im, png_path)
+
+            # 3) Responsive variants
+            self._emit_variants(im, filepath)
+            return True
 
         except Exception as e:
             logger.exception(f"Failed to process PNG {filepath}: {e}")
+            return False
+        finally:
+            if im is not None:
+                im.close()
 
-    def _emit_resized_png_no_encode(self, img: Image.Image, out_path: str):
+    @_profiled("emit_optimized_png")
+    def _emit_optimized_png(self, img: Image.Image, out_path: str):
         """
-        Create a gently downscaled PNG sibling without calling _encode_png.
-        Keep key ancillary chunks when present. Try to approach the cap if possible,
-        but prioritize being smaller than original; stop at min_side_px.
+        Write a PNG sibling under the cap, trying the cheapest options first:
+        a lossless encode at max_compression_png, an exact palette for images with
+        at most 256 colors, then 256-color quantization, and only then a downscale
+        binary-searched from the original size. Stops after png_encode_budget
+        encodes and writes the best fit so far, or the smallest encode.
         """
-        # Measure original PNG size if exists; we won't overwrite original.
-        original_size = None
-        orig_png = os.path.splitext(out_path)[0].replace(self.png_suffix, "") + ".png"
-        if os.path.exists(orig_png):
-            original_size = os.path.getsize(orig_png)
+        cap = self.max_size
+        budget = self.encodes + self.png_encode_budget
+        smallest = None
 
-        # Try iterative downscale (2% default) and save with default PNG writer
-        w, h = img.size
-        best_bytes: Optional[bytes] = None
-        best_len = float("inf")
-
-        current = img.copy()
-        while min(w, h) > self.min_side_px:
-            # Save attempt with preserved metadata but no custom _encode_png
-            attempt = self._save_png_default_bytes(current, img.info)
-            if attempt and len(attempt) < best_len:
-                best_bytes = attempt
-                best_len = len(attempt)
-
-            # Stop if under cap (nice-to-have) or already smaller than original
-            if (best_len <= self.max_size) or (original_size and best_len < original_size):
-                break
+        def encode(im):
+            nonlocal smallest
+            b = self._save_png_bytes(im, img.info, keep_transparency=im.mode == img.mode)
+            if b and (smallest is None or len(b) < len(smallest)):
+                smallest = b
+            return b
+
+        def write(b, how):
+            self._write(out_path, b)
+            logger.debug(f"Wrote {os.path.basename(out_path)} ({len(b)//1024} KB, {how})")
 
-            # gentle 2% shrink (configurable by scale_step)
-            w = max(self.min_side_px, ceil(w * (1 - self.scale_step)))
-            h = max(self.min_side_px, ceil(h * (1 - self.scale_step)))
-            current = current.resize((w, h), Image.LANCZOS)
+        # 1) Lossless
+        b = encode(img)
+        if b and len(b) <= cap:
+            return write(b, "lossless")
+
+        # A color key (tRNS of an RGB or L image) only holds in the mode it was
+        # given for: derive the other encodes from a copy with the key as alpha
+        source = img
+        if "transparency" in img.info and img.mode in ("RGB", "L"):
+            source = img.convert("RGBA")
+
+        palette = self._exact_palette(source)
+        if palette is not None:
+            b = encode(palette)
+            if b and len(b) <= cap:
+                return write(b, "lossless palette")
+
+        # 2) Lossy: quantize, then downscale what we have
+        lossy = palette is None and source.mode in ("RGB", "RGBA")
+        if lossy and self.encodes < budget:
+            b = encode(self._quantize(source))
+            if b and len(b) <= cap:
+                return write(b, "quantized")
+
+        def attempt(scale):
+            w, h = source.size
+            current = source.resize((max(1, round(w * scale)), max(1, round(h * scale))), Image.LANCZOS)
+            if palette is not None or lossy:
+                current = self._quantize(current)
+            return encode(current), current
+
+        if smallest is None:
+            return
+        fit = self._largest_fitting_scale(img.size, cap, len(b) if b else len(smallest), attempt, budget)
+        if fit is not None:
+            return write(fit[0], "resized")
+        if smallest:
+            write(smallest, "over cap")
+
+    @staticmethod
+    def _exact_palette(img: Image.Image) -> Optional[Image.Image]:
+        """The image as a palette image, if that can be done without changing a pixel."""
+        if img.mode not in ("RGB", "RGBA"):
+            return None
+        colors = img.getcolors(256)
+        if colors is None:
+            return None
+
+        if img.mode == "RGB":
+            palette = img.quantize(colors=256, method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+            if ImageChops.difference(palette.convert("RGB"), img).getbbox() is None:
+                return palette
+            return None
 
-        if best_bytes:
-            self._write(out_path, best_bytes)
-            logger.info(f"Wrote {os.path.basename(out_path)} ({best_len//1024} KB)")
+        # Pillow can't quantize RGBA exactly. Give each color a 16-bit key, (R + B * fb) and
+        # (G + A * fa) mod 256 with odd fb and fa that keep the keys apart, computed for every
+        # pixel with lookup tables, then look the key's color index up
+        colors = [color for _, color in colors]
+        for fb, fa in ((fb, fa) for fb in range(1, 256, 2) for fa in range(1, 256, 2)):
+            keys = {(r + b * fb) % 256 * 256 + (g + a * fa) % 256: i for i, (r, g, b, a) in enumerate(colors)}
+            if len(keys) == len(colors):
+                break
         else:
-            # fallback: write one pass without resize
-            bytes_once = self._save_png_default_bytes(img, img.info)
-            if bytes_once:
-                self._write(out_path, bytes_once)
-                logger.info(f"Wrote {os.path.basename(out_path)} ({len(bytes_once)//1024} KB) (no resize improvement)")
+            return None
+        r, g, b, a = img.split()
+        high = ImageChops.add_modulo(r, b.point([v * fb % 256 for v in range(256)]))
+        low = ImageChops.add_modulo(g, a.point([v * fa % 256 for v in range(256)]))
+        key = ImageMath.lambda_eval(lambda args: args["high"] * 256 + args["low"], high=high, low=low)
+        lut = [0] * 65536
+        for k, i in keys.items():
+            lut[k] = i
+        palette = Image.frombytes("P", img.size, key.point(lut, "L").tobytes())
+        palette.putpalette(b"".join(bytes(color) for color in colors), rawmode="RGBA")
+        if ImageChops.difference(palette.convert("RGBA"), img).getbbox() is None:
+            return palette
+        return None
+
+    @staticmethod
+    def _quantize(img: Image.Image) -> Image.Image:
+        if img.mode == "P":
+            return img
+        if img.mode != "RGBA":
+            img = img.convert("RGB")
+        method = Image.Quantize.FASTOCTREE if img.mode == "RGBA" else Image.Quantize.MEDIANCUT
+        return img.quantize(colors=256, method=method)
 
-    def _save_png_default_bytes(self, img: Image.Image, info: dict) -> Optional[bytes]:
+    def _save_png_bytes(self, img: Image.Image, info: dict, keep_transparency: bool = True) -> Optional[bytes]:
         """
-        Save PNG to bytes WITHOUT using _encode_png. Preserve common metadata.
+        Save PNG to bytes at max_compression_png, preserving common metadata.
         """
+        self.encodes += 1
         buf = io.BytesIO()
-        save_kwargs = dict(format="PNG")  # no optimize/compress_level dance
+        save_kwargs = dict(
+            format="PNG",
+            compress_level=self.max_compression_png,
+            optimize=self.max_compression_png >= 9,
+        )
         # Preserve common chunks that affect appearance
         if "icc_profile" in info:
             save_kwargs["icc_profile"] = info.get("icc_profile")
@@ -180,53 +551,130 @@ class MediaOptimizer:
             save_kwargs["gamma"] = info.get("gamma")
         if "dpi" in info:
             save_kwargs["dpi"] = info.get("dpi")
-        if "transparency" in info:
+        # A transparent color/index only means something in the original mode,
+        # and Pillow would otherwise take the one a derived image inherited
+        if "transparency" in info and keep_transparency:
             save_kwargs["transparency"] = info.get("transparency")
+        elif not keep_transparency:
+            save_kwargs["transparency"] = None
         try:
             img.save(buf, **save_kwargs)
             return buf.getvalue()
         except Exception as e:
-            logger.warning(f"Default PNG save failed: {e}")
+            logger.warning(f"PNG save failed: {e}")
             return None
 
+    # -------------------- responsive variants --------------------
+
+    def _emit_variants(self, img: Image.Image, filepath: str):
+        """
+        Write `{base}-{width}w.{format}` for every configured width narrower than
+        the image (or the image's own width if none is), resizing from the original.
+        """
+        if not self.variant_widths or not self.variant_formats:
+            return
+
+        base, _ = os.path.splitext(filepath)
+        w, h = img.size
+        widths = [vw for vw in self.variant_widths if vw < w] or [w]
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+
+        for width in widths:
+            current = img if width == w else img.resize((width, max(1, round(h * width / w))), Image.LANCZOS)
+            for fmt in self.variant_formats:
+                self.encodes += 1
+                buf = io.BytesIO()
+                current.save(buf, format=fmt.upper(), quality=self.variant_quality)
+                self._write(f"{base}-{width}w.{fmt}", buf.getvalue())
+            del current
+
     # -------------------- shared helpers --------------------
 
+    @_profiled("best_jpeg_bytes")
     def _best_jpeg_bytes(self, img: Image.Image, cap: int) -> Optional[bytes]:
         """
-        Try gentle qualities (100→min) and, if needed, gentle 2% downscales to meet cap.
+        Find the largest size, then the highest ladder quality, whose JPEG fits the cap.
+        The start scale is predicted from the byte ratio, then both scale and quality
+        are binary-searched; every resize starts from the original image. Stops after
+        jpeg_encode_budget encodes and returns the best fit so far, or the smallest encode.
         """
-        img_enc = img.convert("RGB")
-        attempts = []
+        img_enc = img if img.mode == "RGB" else img.convert("RGB")
+        qualities = sorted(self.jpg_qualities)  # ascending
+        budget = self.encodes + self.jpeg_encode_budget
+        smallest = None
+
+        def encode(im, quality):
+            nonlocal smallest
+            b = self._encode_jpeg(im, quality)
+            if smallest is None or len(b) < len(smallest):
+                smallest = b
+            return b
+
+        def highest_quality(im, fitting):
+            # fitting is the encode at qualities[0], known to be under cap
+            lo, hi = 0, len(qualities) - 1
+            while lo < hi and self.encodes < budget:
+                mid = (lo + hi + 1) // 2
+                b = encode(im, qualities[mid])
+                if len(b) <= cap:
+                    lo, fitting = mid, b
+                else:
+                    hi = mid - 1
+            return fitting
 
         # First: compression without resize
-        for q in self.jpg_qualities:
-            b = self._encode_jpeg(img_enc, q)
-            attempts.append(b)
-            if len(b) <= cap:
+        b = encode(img_enc, qualities[-1])
+        if len(b) <= cap:
+            return b
+        b = encode(img_enc, qualities[0])
+        if len(b) <= cap:
+            return highest_quality(img_enc, b)
+
+        # Then: search the largest scale that fits at the lowest quality
+        def attempt(scale):
+            w, h = img_enc.size
+            current = img_enc.resize((max(1, round(w * scale)), max(1, round(h * scale))), Image.LANCZOS)
+            return encode(current, qualities[0]), current
+
+        fit = self._largest_fitting_scale(img_enc.size, cap, len(b), attempt, budget)
+        if fit is None:
+            return smallest
+        return highest_quality(fit[1], fit[0])
+
+    def _largest_fitting_scale(self, size, cap: int, full_size_len: int, attempt, budget: int):
+        """
+        Binary-search the largest scale (down to min_side_px) at which attempt(scale)
+        encodes under cap, starting from a guess based on the byte ratio, to a
+        precision of scale_step. attempt returns (bytes, image); so does this,
+        for the best fit, or None when nothing fit within the encode budget.
+        """
+        min_scale = min(1.0, self.min_side_px / min(size))
+        too_big, too_big_len = 1.0, full_size_len
+        fit_scale, fit = None, None
+        while self.encodes < budget:
+            if fit_scale is None:
+                # bytes grow roughly with pixel count; aim slightly below the cap
+                scale = max(min_scale, too_big * sqrt(cap / too_big_len) * 0.97)
+            elif too_big / fit_scale - 1 > self.scale_step:
+                scale = sqrt(fit_scale * too_big)
+            else:
                 break
 
-        best = min(attempts, key=len) if attempts else None
-        if best and len(best) <= cap:
-            return best
-
-        # Then: gentle downscale loop
-        w, h = img_enc.size
-        current = img_enc
-        best_len = len(best) if best else float("inf")
-        while min(w, h) > self.min_side_px:
-            w = max(self.min_side_px, ceil(w * (1 - self.scale_step)))
-            h = max(self.min_side_px, ceil(h * (1 - self.scale_step)))
-            current = current.resize((w, h), Image.LANCZOS)
-            for q in self.jpg_qualities:
-                b = self._encode_jpeg(current, q)
-                if len(b) < best_len:
-                    best = b
-                    best_len = len(b)
-                if best_len <= cap:
-                    return best
-        return best
+            b, im = attempt(scale)
+            if b and len(b) <= cap:
+                fit_scale, fit = scale, (b, im)
+            else:
+                # drop the rejected image before the next attempt resizes another
+                del im
+                too_big = scale
+                too_big_len = len(b) if b else too_big_len
+                if scale <= min_scale:
+                    break
+        return fit
 
     def _encode_jpeg(self, img: Image.Image, quality: int) -> bytes:
+        self.encodes += 1
         buf = io.BytesIO()
         img.save(
             buf,
@@ -238,19 +686,18 @@ class MediaOptimizer:
         )
         return buf.getvalue()
 
-    @staticmethod
-    def _read_bytes(path: str) -> bytes:
-        with open(path, "rb") as f:
-            return f.read()
-
-    @staticmethod
-    def _write(path: str, data: bytes):
+    def _write(self, path: str, data: bytes):
+        # Replace rather than write through: build files may be hardlinks to sources
         os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, "wb") as f:
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, "wb") as f:
             f.write(data)
+        os.replace(tmp_path, path)
+        if self._written is not None:
+            self._written.append(path)
 
     @staticmethod
     def _log_gain(path: str, before: int, after: int):
         pct = 100 * (1 - after / before)
-        logger.info(f"Optimized {os.path.basename(path)}: {before//1024} KB → {after//1024} KB ({pct:.1f}% smaller)")
+        logger.debug(f"Optimized {os.path.basename(path)}: {before//1024} KB → {after//1024} KB ({pct:.1f}% smaller)")
 
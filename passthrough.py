@@ -0,0 +1,38 @@
+import codecs
+import os
+from fnmatch import fnmatch
+
+# src files that are never templates
+PASSTHROUGH_EXTENSIONS = {
+    ".woff", ".woff2", ".ttf", ".otf", ".eot",
+    ".pdf", ".ico", ".png", ".jpg", ".jpeg", ".gif", ".webp", ".avif", ".bmp", ".tif", ".tiff",
+    ".mp3", ".mp4", ".ogg", ".wav", ".webm",
+    ".zip", ".gz", ".br", ".zst", ".tar", ".7z", ".wasm",
+}
+PASSTHROUGH_PATTERNS = ("*.min.js", "*.min.css", "*.map")
+SNIFF_BYTES = 8192
+
+
+def looks_binary(head):
+    """Whether the first bytes of a file say it isn't UTF-8 text."""
+    if b"\0" in head:
+        return True
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+    except UnicodeDecodeError:
+        return True
+    return False
+
+
+def is_passthrough(relative_path, full_path, patterns=()):
+    """
+    Whether a src file is copied as-is instead of rendered: by extension,
+    by glob on its src-relative path, and for anything else by sniffing
+    its first bytes.
+    """
+    if os.path.splitext(relative_path)[1].lower() in PASSTHROUGH_EXTENSIONS:
+        return True
+    if any(fnmatch(relative_path, pattern) for pattern in (*PASSTHROUGH_PATTERNS, *patterns)):
+        return True
+    with open(full_path, "rb") as f:
+        return looks_binary(f.read(SNIFF_BYTES))
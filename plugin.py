@@ -1,7 +1,31 @@
 from loguru import logger
+import hashlib
+import json
 import sys
 import os
-import requests
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from importlib.metadata import entry_points
+
+ENTRY_POINT_GROUP = "jinjapocalypse.plugins"
+_REGISTRY = None
+
+
+def registry():
+    """
+    Factory of every plugin by namespace: the Plugin subclasses defined so far,
+    then the classes other packages advertise under the `jinjapocalypse.plugins`
+    entry point group (entry point name = namespace). Built once; nothing is
+    instantiated, and entry point modules are only imported on first use.
+    """
+    global _REGISTRY
+    if _REGISTRY is None:
+        _REGISTRY = {cls.namespace: cls for cls in Plugin.__subclasses__() if cls.namespace}
+        for entry_point in entry_points(group=ENTRY_POINT_GROUP):
+            _REGISTRY.setdefault(entry_point.name, lambda entry_point=entry_point: entry_point.load()())
+    return _REGISTRY
+
 
 class Plugin():
     namespace = ""
@@ -17,19 +41,84 @@ class Plugin():
 
 
 class Notion(Plugin):
+    """
+    Notion API helpers. Configured through the environment:
+    - NOTION_API_KEY: integration token, only needed when something is fetched
+    - NOTION_API_URL: API base URL (default https://api.notion.com/v1)
+    - NOTION_CACHE_DIR: folder for cached responses (default .cache/notion, empty disables it)
+    - NOTION_CACHE_TTL: seconds a cached response is served without refetching (default 3600)
+
+    Responses are also served from an expired cache entry when the API can't be
+    reached or answers with a server error; other errors (a revoked token, a
+    deleted page) are raised. Blocks are kept in memory for NOTION_CACHE_TTL
+    seconds too, so long-running processes (watch mode) pick up changes.
+    """
+
     namespace = "notion"
+    page_size = 100
+    max_workers = 8
 
     def __init__(self):
         super().__init__()
         self.api_key = os.environ.get("NOTION_API_KEY")
-        
+        self.base_url = os.environ.get("NOTION_API_URL", "https://api.notion.com/v1").rstrip("/")
+        self.cache_dir = os.environ.get("NOTION_CACHE_DIR", ".cache/notion")
+        self.cache_ttl = float(os.environ.get("NOTION_CACHE_TTL", "3600"))
+        self._session = None
+        self._memo = {}
+
     def _require_api_key(self):
         if not self.api_key:
             raise RuntimeError("NOTION_API_KEY is required to use Notion helpers")
 
-    def get_block(self, block_id):  # works with page id too
+    @property
+    def session(self):
+        if self._session is None:
+            # requests is only imported once something is fetched
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            retries = Retry(
+                total=5,
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=("GET",),
+                respect_retry_after_header=True,
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers, max_retries=retries)
+            self._session = requests.Session()
+            self._session.mount("http://", adapter)
+            self._session.mount("https://", adapter)
+        return self._session
+
+    def _cache_path(self, block_id):
+        key = hashlib.sha256(f"{self.base_url}/blocks/{block_id}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _read_cache(self, block_id):
+        if not self.cache_dir:
+            return None, None
+        try:
+            with open(self._cache_path(block_id)) as f:
+                entry = json.load(f)
+            return entry["data"], time.time() - entry["fetched_at"]
+        except (OSError, ValueError, KeyError):
+            return None, None
+
+    def _write_cache(self, block_id, data):
+        if not self.cache_dir:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._cache_path(block_id)
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp_path, "w") as f:
+            json.dump({"fetched_at": time.time(), "data": data}, f)
+        os.replace(tmp_path, path)
+
+    def _fetch_children(self, block_id):
         self._require_api_key()
-        url = f"https://api.notion.com/v1/blocks/{block_id}/children"
+        url = f"{self.base_url}/blocks/{block_id}/children"
 
         headers = {
             "Authorization": f"Bearer {self.api_key}",
@@ -37,12 +126,60 @@ class Notion(Plugin):
             "Content-Type": "application/json",
         }
 
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        data = response.json()
+        results, cursor = [], None
+        while True:
+            params = {"page_size": self.page_size}
+            if cursor:
+                params["start_cursor"] = cursor
+            response = self.session.get(url, headers=headers, params=params, timeout=30)
+            response.raise_for_status()
+            data = response.json()
+            results.extend(data.get("results", []))
+            if not data.get("has_more"):
+                break
+            cursor = data.get("next_cursor")
+
+        return {**data, "results": results, "has_more": False, "next_cursor": None}
+
+    @staticmethod
+    def _unreachable(error):
+        """Whether a failed fetch is worth serving stale data for: no answer, or a server error."""
+        import requests
+
+        response = getattr(error, "response", None)
+        if response is not None:
+            return response.status_code >= 500
+        return isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.RetryError))
+
+    def get_block(self, block_id):  # works with page id too
+        memo = self._memo.get(block_id)
+        if memo is not None and memo[1] > time.time():
+            return memo[0]
+
+        cached, age = self._read_cache(block_id)
+        if cached is not None and age <= self.cache_ttl:
+            data, expires = cached, time.time() + self.cache_ttl - age
+        else:
+            try:
+                data = self._fetch_children(block_id)
+            except OSError as e:  # requests.RequestException included
+                if cached is None or not self._unreachable(e):
+                    raise
+                logger.warning(f"Notion unreachable ({e}), using {int(age)}s old cache for {block_id}")
+                data = cached
+            else:
+                self._write_cache(block_id, data)
+            expires = time.time() + self.cache_ttl
 
+        self._memo[block_id] = (data, expires)
         return data
-    
+
+    def get_blocks(self, block_ids):
+        """get_block for several ids at once, fetched concurrently, in the same order."""
+        block_ids = list(block_ids)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(self.get_block, block_ids))
+
     def _plain_text(self, rich_text):
         return rich_text.get("plain_text", "")
     
@@ -62,3 +199,6 @@ class Notion(Plugin):
 
     def todo_list_from_page(self, page_id):
         return self.todo_list(self.get_block(page_id))
+
+    def todo_lists_from_pages(self, page_ids):
+        return [self.todo_list(block) for block in self.get_blocks(page_ids)]
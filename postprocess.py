@@ -0,0 +1,284 @@
+import functools
+import gzip
+import json
+import os
+import re
+
+from loguru import logger
+
+import profiling
+
+MINIFY_EXTENSIONS = (".html", ".htm", ".css", ".js", ".mjs")
+COMPRESS_EXTENSIONS = (
+    ".html", ".htm", ".css", ".js", ".mjs", ".json", ".map", ".svg", ".xml", ".txt", ".csv",
+    ".ico", ".wasm", ".ttf", ".otf", ".eot",
+)
+# Below this a sidecar costs the server a file lookup for no gain
+MIN_COMPRESS_BYTES = 256
+
+_STRINGS = r'"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\''
+_CSS_COMMENTS = re.compile(rf"({_STRINGS})|/\*(?!!).*?\*/", re.S)
+_CSS_SPACES = re.compile(rf"({_STRINGS})|\s+", re.S)
+# Space before a colon only goes in declarations, those end before any `{`: `a :hover` is a selector
+_CSS_PUNCTUATION = re.compile(rf"({_STRINGS})|\s*([{{}};,>])\s*|\s+(:)(?=[^{{}};]*[;}}])\s*|(:)\s+", re.S)
+_HTML_RAW = re.compile(r"(<(pre|textarea|script|style)\b[^>]*>)(.*?)(</\2\s*>)", re.S | re.I)
+_HTML_COMMENTS = re.compile(r"<!--(?!\[if|\s*\[endif|!).*?-->", re.S)
+_HTML_SPACES = re.compile(r"[ \t\r\f]*\n\s*")
+_SCRIPT_TYPE = re.compile(r"""\btype\s*=\s*["']?([^"'\s>]+)""", re.I)
+_JS_TYPES = {"text/javascript", "application/javascript", "module"}
+
+
+def minify_css(css):
+    """Drop comments (but `/*! ... */`) and the whitespace CSS doesn't need, leaving strings alone."""
+    css = _CSS_COMMENTS.sub(lambda m: m.group(1) or "", css)
+    css = _CSS_SPACES.sub(lambda m: m.group(1) or " ", css)
+    css = _CSS_PUNCTUATION.sub(lambda m: m.group(1) or m.group(2) or m.group(3) or m.group(4), css)
+    return css.replace(";}", "}").strip()
+
+
+def minify_js(js):
+    """
+    Whitespace only, as anything more needs a parser: indentation, trailing
+    spaces and blank lines go, line breaks stay so automatic semicolon
+    insertion is unaffected. Scripts with template literals are left as they are.
+    """
+    if "`" in js:
+        return js
+    lines, continued = [], False
+    for line in js.splitlines():
+        stripped = line.rstrip() if continued else line.strip()
+        if stripped or continued:
+            lines.append(stripped)
+        continued = stripped.endswith("\\")
+    return "\n".join(lines)
+
+
+def _minify_raw(match):
+    opening, tag, content, closing = match.groups()
+    tag = tag.lower()
+    if tag == "style":
+        content = minify_css(content)
+    elif tag == "script":
+        script_type = _SCRIPT_TYPE.search(opening)
+        if script_type is None or script_type.group(1).lower() in _JS_TYPES:
+            content = minify_js(content)
+    return opening + content + closing
+
+
+def minify_html(html):
+    """
+    Drop comments (but conditional ones) and fold every whitespace run that
+    spans a line break into that line break. Runs within a line and the
+    content of <pre> and <textarea> are kept, inline CSS and JS are minified.
+    """
+    parts, position = [], 0
+    for match in _HTML_RAW.finditer(html):
+        parts.append(_minify_text(html[position:match.start()]))
+        parts.append(_minify_raw(match))
+        position = match.end()
+    parts.append(_minify_text(html[position:]))
+    return "".join(parts).strip()
+
+
+def _minify_text(html):
+    return _HTML_SPACES.sub("\n", _HTML_COMMENTS.sub("", html))
+
+
+def minifiable(path):
+    name = os.path.basename(path)
+    return name.lower().endswith(MINIFY_EXTENSIONS) and ".min." not in name
+
+
+def compressible(path):
+    name = os.path.basename(path)
+    return not name.startswith(".") and name.lower().endswith(COMPRESS_EXTENSIONS)
+
+
+@functools.lru_cache(maxsize=None)
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard.ZstdCompressor(level=22)
+
+
+def _minify_one(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            before = f.read()
+    except UnicodeDecodeError:
+        return os.path.getsize(path), None
+    if path.lower().endswith(".css"):
+        after = minify_css(before)
+    elif path.lower().endswith((".js", ".mjs")):
+        after = minify_js(before)
+    else:
+        after = minify_html(before)
+    before_size, after_size = len(before.encode("utf-8")), len(after.encode("utf-8"))
+    if after_size >= before_size:
+        return before_size, None
+
+    # Replace rather than write through: build files may be hardlinks to sources
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(after)
+    os.replace(tmp_path, path)
+    return before_size, after_size
+
+
+def _compress_one(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    sizes = {}
+    encoders = {"gz": lambda d: gzip.compress(d, compresslevel=9, mtime=0)}
+    zstd = _zstd()
+    if zstd is not None:
+        encoders["zst"] = zstd.compress
+    for ext, encode in encoders.items():
+        sidecar = f"{path}.{ext}"
+        compressed = encode(data) if len(data) >= MIN_COMPRESS_BYTES else None
+        if compressed is None or len(compressed) >= len(data):
+            if os.path.exists(sidecar):
+                os.remove(sidecar)
+            continue
+        tmp_path = f"{sidecar}.tmp-{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            f.write(compressed)
+        os.replace(tmp_path, sidecar)
+        sizes[ext] = len(compressed)
+    return len(data), sizes
+
+
+def _in_worker(name, task, path):
+    profiling.drain()
+    with profiling.span(name, "postprocess", path=path):
+        result = task(path)
+    return path, result, profiling.drain()
+
+
+def _map(name, task, paths, jobs):
+    """(path, result) of task over paths, in forked worker processes when there is work for them."""
+    if jobs <= 1 or len(paths) <= 1:
+        for path in paths:
+            with profiling.span(name, "postprocess", path=path):
+                yield path, task(path)
+        return
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("fork")) as executor:
+        chunksize = max(1, len(paths) // (jobs * 4))
+        for path, result, events in executor.map(
+            _in_worker, [name] * len(paths), [task] * len(paths), paths, chunksize=chunksize
+        ):
+            profiling.extend(events)
+            yield path, result
+
+
+def _saving(before, after):
+    percent = 100 * (1 - after / before) if before else 0.0
+    return f"{before / 1024:.1f} KB → {after / 1024:.1f} KB ({percent:.1f}% smaller)"
+
+
+class OutputProcessor:
+    """
+    Post-render stage over the build folder: minifies the HTML, CSS and JS
+    just rendered, and keeps precompressed `.gz` (and `.zst` when the
+    `zstandard` module is installed) sidecars next to every compressible
+    file, for servers that serve them as-is (nginx `gzip_static`, Caddy
+    `precompressed`, ...).
+
+    Sidecars are tracked by the size and mtime of the file they were made
+    from, so only new or changed files are compressed again.
+    """
+
+    filename = "compressed.json"
+    version = 1
+
+    def __init__(self, build_folder, state_folder, jobs=1):
+        self.build_folder = build_folder
+        self.jobs = jobs
+        self.path = os.path.join(state_folder, self.filename)
+        self.files = {}
+
+    @classmethod
+    def load(cls, build_folder, state_folder, jobs=1):
+        processor = cls(build_folder, state_folder, jobs)
+        try:
+            with open(processor.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return processor
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable compression state {processor.path}: {e}")
+            return processor
+        if data.get("version") == cls.version:
+            processor.files = data.get("files", {})
+        return processor
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": self.version, "files": self.files}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def minify(self, outputs):
+        """Minify the given build-relative outputs in place."""
+        paths = [os.path.join(self.build_folder, o) for o in sorted(set(outputs)) if minifiable(o)]
+        paths = [p for p in paths if os.path.exists(p)]
+        total_before = total_after = changed = 0
+        for path, (before, after) in _map("minify", _minify_one, paths, self.jobs):
+            total_before += before
+            if after is None:
+                total_after += before
+                continue
+            changed += 1
+            total_after += after
+            logger.debug(f"Minified {path}: {_saving(before, after)}")
+        if paths:
+            logger.info(f"Minified {changed} of {len(paths)} file(s): {_saving(total_before, total_after)}")
+
+    def _stale(self, relative_path, st):
+        entry = self.files.get(relative_path)
+        if entry is None or (entry["size"], entry["mtime_ns"]) != (st.st_size, st.st_mtime_ns):
+            return True
+        path = os.path.join(self.build_folder, relative_path)
+        return not all(os.path.exists(f"{path}.{ext}") for ext in entry["sidecars"])
+
+    def compress(self):
+        """Write the sidecars of new and changed files, drop those of files that are gone."""
+        found, todo = {}, []
+        for root, dirs, names in os.walk(self.build_folder):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for name in names:
+                path = os.path.join(root, name)
+                relative_path = os.path.relpath(path, self.build_folder)
+                if not compressible(relative_path):
+                    continue
+                st = os.stat(path)
+                found[relative_path] = st
+                if self._stale(relative_path, st):
+                    todo.append(path)
+
+        for relative_path in set(self.files) - set(found):
+            for ext in self.files.pop(relative_path)["sidecars"]:
+                sidecar = os.path.join(self.build_folder, f"{relative_path}.{ext}")
+                if os.path.exists(sidecar):
+                    os.remove(sidecar)
+                    logger.info(f"Removed stale {sidecar}")
+
+        logger.info(f"{len(todo)} of {len(found)} compressible file(s) changed")
+        totals = {}
+        for path, (size, sizes) in _map("compress", _compress_one, todo, self.jobs):
+            relative_path = os.path.relpath(path, self.build_folder)
+            st = found[relative_path]
+            self.files[relative_path] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sidecars": sorted(sizes)}
+            for ext, compressed in sizes.items():
+                before, after = totals.get(ext, (0, 0))
+                totals[ext] = (before + size, after + compressed)
+        for ext, (before, after) in sorted(totals.items()):
+            logger.info(f"Precompressed .{ext}: {_saving(before, after)}")
+        self.save()
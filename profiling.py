@@ -0,0 +1,152 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from loguru import logger
+
+# Recorded events while profiling is enabled, None otherwise
+_EVENTS = None
+
+
+def enable():
+    global _EVENTS
+    _EVENTS = []
+
+
+def enabled():
+    return _EVENTS is not None
+
+
+def add(name, category, started, seconds, **args):
+    if _EVENTS is not None:
+        _EVENTS.append({
+            "name": name,
+            "category": category,
+            "start": started,
+            "seconds": seconds,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        })
+
+
+@contextmanager
+def span(name, category, **args):
+    """Time the block as one event. The yielded args dict can be filled in by the block."""
+    if _EVENTS is None:
+        yield args
+        return
+    started = time.perf_counter()
+    try:
+        yield args
+    finally:
+        add(name, category, started, time.perf_counter() - started, **args)
+
+
+def drain():
+    """Hand over (and forget) the events recorded so far, e.g. from a worker process."""
+    if _EVENTS is None:
+        return []
+    events = list(_EVENTS)
+    _EVENTS.clear()
+    return events
+
+
+def extend(events):
+    if _EVENTS is not None:
+        _EVENTS.extend(events)
+
+
+class Breakdown:
+    """
+    Exclusive time per phase of interleaved work: entering a phase pauses the
+    one it is nested in, so streamed rendering, section parsing and writing
+    each get only their own share.
+    """
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self._stack = []
+        self._mark = 0.0
+
+    @contextmanager
+    def __call__(self, phase):
+        now = time.perf_counter()
+        if self._stack:
+            self.seconds[self._stack[-1]] += now - self._mark
+        self._stack.append(phase)
+        self._mark = now
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self.seconds[self._stack.pop()] += now - self._mark
+            self._mark = now
+
+    def iterate(self, phase, iterable):
+        """Yield from iterable, counting the time spent producing items as phase."""
+        iterator = iter(iterable)
+        while True:
+            with self(phase):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+
+def _label(event):
+    args = event["args"]
+    subject = args.get("file") or args.get("path") or ""
+    return f"{event['name']} {subject}".strip()
+
+
+def report(path, top=10):
+    """
+    Write `<path>.json` (events and per-name totals) and `<path>.trace.json`
+    (Chrome trace format, for chrome://tracing or Perfetto) and log the
+    slowest events.
+    """
+    events = sorted(_EVENTS or [], key=lambda e: e["start"])
+    origin = events[0]["start"] if events else 0.0
+
+    totals = defaultdict(lambda: {"count": 0, "seconds": 0.0})
+    for event in events:
+        totals[event["name"]]["count"] += 1
+        totals[event["name"]]["seconds"] += event["seconds"]
+
+    data = {
+        "totals": dict(sorted(totals.items(), key=lambda item: -item[1]["seconds"])),
+        "events": [{**event, "start": event["start"] - origin} for event in events],
+    }
+    trace = {
+        "displayTimeUnit": "ms",
+        "traceEvents": [
+            {
+                "name": _label(event),
+                "cat": event["category"],
+                "ph": "X",
+                "ts": round((event["start"] - origin) * 1e6, 1),
+                "dur": round(event["seconds"] * 1e6, 1),
+                "pid": event["pid"],
+                "tid": event["tid"],
+                "args": event["args"],
+            }
+            for event in events
+        ],
+    }
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(f"{path}.json", "w") as f:
+        json.dump(data, f, indent=1)
+    with open(f"{path}.trace.json", "w") as f:
+        json.dump(trace, f)
+    logger.info(f"Wrote profile to {path}.json and {path}.trace.json")
+
+    for name, total in data["totals"].items():
+        logger.info(f"Profile: {name} x{total['count']} {total['seconds']:.3f}s")
+    for event in sorted(events, key=lambda e: -e["seconds"])[:top]:
+        logger.info(f"Slowest: {event['seconds']:.3f}s {_label(event)}")
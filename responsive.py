@@ -0,0 +1,72 @@
+import json
+import os
+import re
+
+from loguru import logger
+
+VARIANT_PATTERN = re.compile(r"-(\d+)w\.(webp|avif)$")
+MIME_TYPES = {"avif": "image/avif", "webp": "image/webp"}
+
+
+class VariantManifest:
+    """
+    Index of the responsive variants written next to each media file, keyed by
+    path relative to the media folder:
+
+        {"photo.jpg": {"width": 1200, "height": 900,
+                       "variants": {"webp": [[480, "photo-480w.webp"], ...]}}}
+    """
+
+    filename = "variants.json"
+
+    def __init__(self, media_build_folder):
+        self.folder = media_build_folder
+        self.path = os.path.join(media_build_folder, self.filename)
+        self.images = {}
+
+    @classmethod
+    def load(cls, media_build_folder):
+        manifest = cls(media_build_folder)
+        try:
+            with open(manifest.path) as f:
+                manifest.images = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable variant manifest {manifest.path}: {e}")
+        return manifest
+
+    def save(self):
+        os.makedirs(self.folder, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.images, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def update(self, path, outputs):
+        """Record the variants among outputs, the files written for media file path; returns whether they changed."""
+        relative_path = os.path.relpath(path, self.folder)
+        variants = {}
+        for output in sorted(outputs):
+            match = VARIANT_PATTERN.search(output)
+            if match:
+                variants.setdefault(match.group(2), []).append(
+                    [int(match.group(1)), os.path.relpath(output, self.folder)]
+                )
+
+        if not variants:
+            return self.remove(relative_path)
+
+        from PIL import Image
+
+        with Image.open(path) as im:
+            width, height = im.size
+        for widths in variants.values():
+            widths.sort()
+        entry = {"width": width, "height": height, "variants": variants}
+        changed = self.images.get(relative_path) != entry
+        self.images[relative_path] = entry
+        return changed
+
+    def remove(self, relative_path):
+        return self.images.pop(relative_path, None) is not None
@@ -0,0 +1,139 @@
+import json
+import os
+import re
+
+from loguru import logger
+
+TAG_PATTERN = re.compile(r"\[---\s*(\S+?)\s*--\s*(\{.*\})\s*\]")
+
+# Characters str.splitlines() breaks on
+LINE_BREAKS = "\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"
+
+
+class SectionScanner:
+    """
+    Splits rendered output into sections while it streams in.
+
+    Chunks are cut into lines (with `str.splitlines` semantics), lines outside
+    any section go to `on_lines` in batches, and each section is handed to `on_section` as
+    soon as its closing token arrives. Sections nest: a token whose type starts
+    with `end_` closes the innermost open section, any other token opens one.
+    Only the lines of currently open sections are held in memory.
+    """
+
+    buffer_size = 64 * 1024
+
+    def __init__(self, on_lines, on_section):
+        self.on_lines = on_lines
+        self.on_section = on_section
+        self._pending = ""
+        self._buffer = []
+        self._buffered = 0
+        self._stack = []
+
+    def feed(self, chunk):
+        # Jinja yields many tiny chunks, split them into lines in batches
+        self._buffer.append(chunk)
+        self._buffered += len(chunk)
+        if self._buffered >= self.buffer_size:
+            self._flush()
+
+    def _flush(self):
+        text = self._pending + "".join(self._buffer)
+        self._buffer, self._buffered = [], 0
+
+        # A trailing "\r" may be the first half of "\r\n"
+        self._pending = ""
+        if text.endswith("\r"):
+            text, self._pending = text[:-1], "\r"
+        lines = text.splitlines()
+        if text and text[-1] not in LINE_BREAKS:
+            self._pending = lines.pop() + self._pending
+        self._scan(lines)
+
+    def close(self):
+        self._flush()
+        self._scan(self._pending.splitlines())
+        self._pending = ""
+        if self._stack:
+            logger.critical(f"Found unclosed section: \n{self._stack[-1][1]}")
+            raise Exception("Found unclosed section.")
+
+    def _scan(self, lines):
+        # Only lines that may hold a token are looked at one by one
+        start = 0
+        for i in [i for i, line in enumerate(lines) if "[---" in line]:
+            self._text(lines[start:i])
+            self._token(lines[i])
+            start = i + 1
+        self._text(lines[start:])
+
+    def _text(self, lines):
+        if not lines:
+            return
+        if self._stack:
+            self._stack[-1][1].extend(lines)
+        else:
+            self.on_lines(lines)
+
+    def _token(self, line):
+        tag_match = TAG_PATTERN.search(line)
+        if tag_match is None:
+            self._text([line])
+            return
+
+        tag = json.loads(tag_match.group(2))
+        if not str(tag.get("type", "")).startswith("end_"):
+            self._stack.append((tag, []))
+        elif self._stack:
+            opening_tag, lines = self._stack.pop()
+            self.on_section({
+                "opening_tag": opening_tag,
+                "closing_tag": tag,
+                "_content": "\n".join(lines).strip(),
+            })
+        else:
+            logger.warning(f"Ignoring {tag.get('type')} without an open section")
+
+
+class OutputFile:
+    """
+    Text file written in batches of lines to a temporary path. On close it replaces
+    `path` if anything but whitespace was written, and is dropped otherwise.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = f"{path}.{os.getpid()}.tmp"
+        self.blank = True
+        self._first = True
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(self.tmp_path, "w")
+
+    def write_lines(self, lines):
+        if not self._first:
+            self._file.write("\n")
+        self._file.write("\n".join(lines))
+        self._first = False
+        if self.blank and any(line.strip() for line in lines):
+            self.blank = False
+
+    def close(self):
+        self._file.close()
+        if self.blank:
+            os.remove(self.tmp_path)
+            return False
+        os.replace(self.tmp_path, self.path)
+        return True
+
+    def discard(self):
+        self._file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.discard()
@@ -0,0 +1,182 @@
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+
+from loguru import logger
+
+from incremental import file_hash
+
+FICLONE = 0x40049409
+
+
+def _clone_or_copy(source, destination):
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        try:
+            # Reflink: the filesystem shares blocks until one side is written
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+
+        try:
+            # In-kernel copy, no round trip through user space
+            remaining = os.fstat(src.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+            return
+        except (OSError, AttributeError):
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+
+    # shutil uses sendfile where it can
+    shutil.copyfile(source, destination)
+
+
+def fast_copy(source, destination, link=False):
+    """
+    Copy source to destination using the cheapest means the filesystem offers:
+    a hardlink when `link` is set, else a reflink, copy_file_range or sendfile.
+    The destination is replaced atomically, never written through, and gets
+    the permission bits of source.
+    """
+    if link and os.path.exists(destination) and os.path.samefile(source, destination):
+        # Already a hardlink of source; renaming another link over it would do nothing
+        return
+    os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(destination) or ".")
+    os.close(fd)
+    try:
+        linked = False
+        if link:
+            os.remove(tmp_path)
+            try:
+                os.link(source, tmp_path)
+                linked = True
+            except OSError:
+                _clone_or_copy(source, tmp_path)
+        else:
+            _clone_or_copy(source, tmp_path)
+        if not linked:
+            # mkstemp creates the file owner-only
+            shutil.copymode(source, tmp_path)
+        os.replace(tmp_path, destination)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class MediaSync:
+    """
+    Keeps build/media in step with media/ across builds.
+
+    Sources are compared by size and mtime, then by hash, against the state
+    recorded by the previous build; only new or changed files are copied and
+    handed back for optimization. Outputs of sources that disappeared are pruned.
+    """
+
+    filename = "media-sync.json"
+    version = 1
+
+    def __init__(self, source_folder, destination_folder, state_folder, settings=None):
+        self.source_folder = source_folder
+        self.destination_folder = destination_folder
+        self.path = os.path.join(state_folder, self.filename)
+        self.settings = settings
+        self.files = {}
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable media state {self.path}: {e}")
+            return
+
+        files = data.get("files", {})
+        if data.get("version") != self.version or data.get("settings") != self.settings:
+            logger.info("Media settings changed, syncing every media file")
+            # Only the outputs are kept, to be pruned once the new ones are known
+            files = {relative_path: {"outputs": entry.get("outputs", [])} for relative_path, entry in files.items()}
+        self.files = files
+
+    def save(self):
+        data = {"version": self.version, "settings": self.settings, "files": self.files}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def _remove(self, relative_paths):
+        for relative_path in relative_paths:
+            path = os.path.join(self.destination_folder, relative_path)
+            if os.path.exists(path):
+                os.remove(path)
+                logger.info(f"Removed stale {path}")
+
+    def sync(self, optimizable=lambda path: False):
+        """
+        Copy new and changed media, prune outputs of removed ones and return the
+        destination paths that were copied, for the optimizer to process.
+        Files the optimizer won't touch are hardlinked when possible.
+        """
+        self.load()
+        current = set()
+        changed = []
+        unchanged = 0
+
+        for root, _, names in os.walk(self.source_folder):
+            for name in names:
+                source = os.path.join(root, name)
+                relative_path = os.path.relpath(source, self.source_folder)
+                destination = os.path.join(self.destination_folder, relative_path)
+                current.add(relative_path)
+
+                st = os.stat(source)
+                entry = self.files.get(relative_path)
+                outputs_exist = entry and all(
+                    os.path.exists(os.path.join(self.destination_folder, o)) for o in entry["outputs"]
+                )
+                stamp = (entry.get("size"), entry.get("mtime_ns")) if entry else None
+                if entry and outputs_exist and stamp == (st.st_size, st.st_mtime_ns):
+                    unchanged += 1
+                    continue
+
+                digest = file_hash(source)
+                if entry and outputs_exist and entry.get("hash") == digest:
+                    entry.update(size=st.st_size, mtime_ns=st.st_mtime_ns)
+                    unchanged += 1
+                    continue
+
+                fast_copy(source, destination, link=not optimizable(destination))
+                self.files[relative_path] = {
+                    "size": st.st_size,
+                    "mtime_ns": st.st_mtime_ns,
+                    "hash": digest,
+                    "outputs": [relative_path],
+                    "previous_outputs": entry["outputs"] if entry else [],
+                }
+                changed.append(destination)
+
+        for relative_path in sorted(set(self.files) - current):
+            logger.info(f"{relative_path} was removed from {self.source_folder}")
+            self._remove(self.files.pop(relative_path)["outputs"])
+
+        logger.info(f"Synced media: {len(changed)} copied, {unchanged} unchanged")
+        return changed
+
+    def record_outputs(self, destination, outputs):
+        """Remember what the optimizer wrote for destination, pruning what it no longer writes."""
+        relative_path = os.path.relpath(destination, self.destination_folder)
+        entry = self.files[relative_path]
+        entry["outputs"] = sorted({relative_path} | {os.path.relpath(o, self.destination_folder) for o in outputs})
+        self._remove(set(entry.pop("previous_outputs", [])) - set(entry["outputs"]))
@@ -0,0 +1,210 @@
+import hashlib
+import re
+from collections.abc import Mapping
+from types import SimpleNamespace
+
+from jinja2 import BaseLoader, Environment, FileSystemBytecodeCache, TemplateNotFound
+from jinja2.bccache import Bucket
+from jinja2.lexer import Lexer
+
+from incremental import record_dependency
+
+HOURRI_BLOCK_START = "/o/"
+HOURRI_BLOCK_END = "\\o\\"
+HOURRI_VARIABLE = "\\o/"
+
+# Placeholders handed to jinja's Lexer so that we can find each delimiter in
+# the compiled rules and swap it for an "hourri or curly" alternation.
+_DELIMITERS = {
+    "block_start_string": ("\x00bs\x00", (HOURRI_BLOCK_START, "{%")),
+    "block_end_string": ("\x00be\x00", (HOURRI_BLOCK_END, "%}")),
+    "variable_start_string": ("\x00vs\x00", (HOURRI_VARIABLE, "{{")),
+    "variable_end_string": ("\x00ve\x00", (HOURRI_VARIABLE, "}}")),
+}
+
+
+class HourriLexer(Lexer):
+    """
+    Jinja lexer accepting both hourris and plain jinja delimiters, so that
+    `\\o/ x \\o/` and `{{ x }}` (or `/o/ if \\o\\` and `{% if %}`) can be mixed
+    freely without rewriting the template source.
+    """
+
+    def __init__(self, environment):
+        settings = SimpleNamespace(
+            comment_start_string=environment.comment_start_string,
+            comment_end_string=environment.comment_end_string,
+            line_statement_prefix=environment.line_statement_prefix,
+            line_comment_prefix=environment.line_comment_prefix,
+            trim_blocks=environment.trim_blocks,
+            lstrip_blocks=environment.lstrip_blocks,
+            newline_sequence=environment.newline_sequence,
+            keep_trailing_newline=environment.keep_trailing_newline,
+            **{attr: placeholder for attr, (placeholder, _) in _DELIMITERS.items()},
+        )
+        super().__init__(settings)
+
+        for state, rules in self.rules.items():
+            self.rules[state] = [rule._replace(pattern=self._expand(rule.pattern)) for rule in rules]
+
+    @staticmethod
+    def _expand(pattern):
+        source = pattern.pattern
+        for placeholder, alternatives in _DELIMITERS.values():
+            alternation = "(?:" + "|".join(re.escape(a) for a in alternatives) + ")"
+            source = source.replace(re.escape(placeholder), alternation)
+        return re.compile(source, pattern.flags)
+
+
+_LEXER_CACHE = {}
+
+
+class HourriEnvironment(Environment):
+    def __init__(self, **options):
+        options.setdefault("block_start_string", HOURRI_BLOCK_START)
+        options.setdefault("block_end_string", HOURRI_BLOCK_END)
+        options.setdefault("variable_start_string", HOURRI_VARIABLE)
+        options.setdefault("variable_end_string", HOURRI_VARIABLE)
+        super().__init__(**options)
+
+    @property
+    def lexer(self):
+        key = (
+            self.comment_start_string,
+            self.comment_end_string,
+            self.line_statement_prefix,
+            self.line_comment_prefix,
+            self.trim_blocks,
+            self.lstrip_blocks,
+            self.newline_sequence,
+            self.keep_trailing_newline,
+        )
+        lexer = _LEXER_CACHE.get(key)
+        if lexer is None:
+            lexer = _LEXER_CACHE[key] = HourriLexer(self)
+        return lexer
+
+
+class SourceLoader(BaseLoader):
+    """Serves templates straight from a mapping of src-relative paths to contents."""
+
+    def __init__(self, sources):
+        self.sources = sources
+
+    def get_source(self, environment, template):
+        try:
+            source = self.sources[template]
+        except KeyError:
+            raise TemplateNotFound(template)
+        return source, None, lambda: self.sources.get(template) == source
+
+
+class RenderedSources(Mapping):
+    """
+    The `src` mapping exposed to templates. A file is rendered the first time
+    it is looked up and the result is reused by every later lookup, including
+    the write to disk, so each file is rendered exactly once per build.
+    Files nobody included yet are streamed to disk with `stream` instead.
+    Passthrough files are not templates and are only read if looked up.
+    """
+
+    keep_limit = 1024 * 1024
+
+    def __init__(self, sources, render, stream=None, passthrough=()):
+        self.sources = sources
+        self.passthrough = passthrough
+        self.render = render
+        self.render_stream = stream
+        self.rendered = {}
+        self._rendering = []
+
+    def _enter(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self._rendering:
+            chain = self._rendering[self._rendering.index(key):] + [key]
+            raise RuntimeError(f"Include cycle: {' -> '.join(chain)}")
+
+    def __getitem__(self, key):
+        record_dependency("src", key)
+        if key in self.rendered:
+            return self.rendered[key]
+
+        self._enter(key)
+        self._rendering.append(key)
+        try:
+            content = self.render(key)
+        except RuntimeError:
+            raise
+        except Exception as e:
+            # Jinja turns lookup errors into undefined values, don't let it hide this one
+            raise RuntimeError(f"Failed to render {key}: {e!r}") from e
+        finally:
+            self._rendering.pop()
+
+        self.rendered[key] = content
+        return content
+
+    def stream(self, key):
+        """
+        Yield the rendered content of `key` in chunks. Content up to
+        `keep_limit` characters is kept for later lookups, anything bigger
+        (typically a template emitting many pages) is only streamed.
+        """
+        if key in self.rendered or self.render_stream is None:
+            yield self[key]
+            return
+
+        self._enter(key)
+        self._rendering.append(key)
+        kept, size = [], 0
+        try:
+            for chunk in self.render_stream(key):
+                if kept is not None:
+                    size += len(chunk)
+                    if size <= self.keep_limit:
+                        kept.append(chunk)
+                    else:
+                        kept = None
+                yield chunk
+        except RuntimeError:
+            raise
+        except Exception as e:
+            raise RuntimeError(f"Failed to render {key}: {e!r}") from e
+        finally:
+            self._rendering.pop()
+
+        if kept is not None:
+            self.rendered[key] = "".join(kept)
+
+    def __contains__(self, key):
+        return key in self.sources or key in self.passthrough
+
+    def __iter__(self):
+        yield from self.sources
+        yield from self.passthrough
+
+    def __len__(self):
+        return len(self.sources) + len(self.passthrough)
+
+    def clear(self):
+        self.rendered.clear()
+
+
+class ContentBytecodeCache(FileSystemBytecodeCache):
+    """
+    On-disk bytecode cache keyed by template name, content and lexer settings
+    rather than file mtimes, so compiled templates survive fresh checkouts.
+    The name is part of the key because the compiled code carries it, for
+    errors and tracebacks.
+    """
+
+    def get_bucket(self, environment, name, filename, source):
+        settings = repr(sorted(
+            (attr, getattr(environment, attr))
+            for attr in (*_DELIMITERS, "trim_blocks", "lstrip_blocks", "keep_trailing_newline")
+        ))
+        key = hashlib.sha256(f"{settings}\0{name}\0{source}".encode("utf-8")).hexdigest()
+        bucket = Bucket(environment, key, key)
+        self.load_bytecode(bucket)
+        return bucket
@@ -0,0 +1,65 @@
+import pytest
+
+from jinjapocalypse import Jinjapocalypse
+
+
+def build(root, jobs=1, **options):
+    Jinjapocalypse(
+        src_folder=str(root / "src"),
+        build_folder=str(root / "build"),
+        media_folder=str(root / "media"),
+        state_folder=str(root / "state"),
+        jobs=jobs,
+        **options,
+    ).process_files()
+
+
+def test_data_loaded_by_lib_is_a_dependency(tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "lib.jinja").write_text('{% set site = _o_["load_yaml"]("site.yaml") %}')
+    (src / "site.yaml").write_text("title: Old\n")
+    (src / "index.html").write_text("<h1>\\o/ site.title \\o/</h1>")
+    build(tmp_path)
+    assert (tmp_path / "build" / "index.html").read_text() == "<h1>Old</h1>"
+
+    (src / "site.yaml").write_text("title: Newer\n")
+    build(tmp_path)
+    assert (tmp_path / "build" / "index.html").read_text() == "<h1>Newer</h1>"
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_failed_build_keeps_what_rendered(tmp_path, jobs):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "site.yaml").write_text("title: Old\n")
+    page = '{% set site = _o_["load_yaml"]("site.yaml") %}<h1>\\o/ site.title \\o/</h1>'
+    (src / "a.html").write_text(page)
+    # In a subfolder, so a serial build renders it last
+    (src / "z").mkdir()
+    (src / "z" / "b.html").write_text(page)
+    build(tmp_path, jobs)
+
+    (src / "site.yaml").write_text("title: Newer\n")
+    (src / "z" / "b.html").write_text("{% if %}")
+    with pytest.raises(Exception):
+        build(tmp_path, jobs)
+    assert (tmp_path / "build" / "a.html").read_text() == "<h1>Newer</h1>"
+
+    # a.html is up to date and not rendered again, z/b.html is
+    (tmp_path / "build" / "a.html").write_text("kept")
+    (src / "z" / "b.html").write_text(page)
+    build(tmp_path, jobs)
+    assert (tmp_path / "build" / "a.html").read_text() == "kept"
+    assert (tmp_path / "build" / "z" / "b.html").read_text() == "<h1>Newer</h1>"
+
+
+def test_turning_minify_on_renders_again(tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "index.html").write_text("<p>\n    <!-- note -->\n    Hi\n</p>\n")
+    build(tmp_path)
+    assert "note" in (tmp_path / "build" / "index.html").read_text()
+
+    build(tmp_path, minify=True)
+    assert "note" not in (tmp_path / "build" / "index.html").read_text()
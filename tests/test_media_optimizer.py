@@ -0,0 +1,35 @@
+from PIL import Image
+
+from media_optimizer import MediaOptimizer
+
+KEY = (255, 0, 255)
+
+
+def test_rgb_color_key_png_is_optimized_under_the_cap(tmp_path):
+    # Noise doesn't fit the cap losslessly: palette, quantize and resize attempts all run
+    im = Image.effect_noise((600, 400), 80).convert("RGB")
+    im.paste(KEY, (0, 0, 300, 200))
+    path = tmp_path / "keyed.png"
+    im.save(path, transparency=KEY)
+    assert path.stat().st_size > 100 * 1024
+
+    optimizer = MediaOptimizer(max_size_kb=100, convert_png_to_jpg=False)
+    [result] = optimizer.optimize_files([str(path)])
+
+    assert result["after"] <= 100 * 1024
+    with Image.open(path) as out:
+        out = out.convert("RGBA")
+        assert out.getpixel((0, 0))[3] == 0
+        assert out.getpixel((out.width - 1, out.height - 1))[3] > 200
+
+
+def test_rgba_exact_palette_keeps_every_pixel():
+    # Same RGB under different alphas, and 256 colors in all
+    colors = [(0, 0, 0, a) for a in range(128)] + [(x, 255 - x, x // 2, 255) for x in range(128)]
+    im = Image.new("RGBA", (64, 64))
+    im.putdata([colors[(i * 7) % len(colors)] for i in range(64 * 64)])
+
+    palette = MediaOptimizer._exact_palette(im)
+
+    assert palette.mode == "P"
+    assert list(palette.convert("RGBA").getdata()) == list(im.getdata())
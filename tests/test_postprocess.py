@@ -0,0 +1,17 @@
+from postprocess import _minify_one, minify_css, minify_html
+
+
+def test_minify_html_does_not_grow_small_files():
+    assert minify_html("<p>hi</p>") == "<p>hi</p>"
+
+
+def test_output_not_made_smaller_is_kept(tmp_path):
+    path = tmp_path / "tiny.html"
+    path.write_text("<p>hi</p>")
+    assert _minify_one(str(path)) == (9, None)
+    assert path.read_text() == "<p>hi</p>"
+
+
+def test_minify_css_strips_spaces_around_declaration_colons():
+    css = "a :hover { color : red ; }\n@media (min-width : 600px) { p :first-child { margin :0 } }"
+    assert minify_css(css) == "a :hover{color:red}@media (min-width :600px){p :first-child{margin:0}}"
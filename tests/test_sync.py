@@ -0,0 +1,41 @@
+import os
+import stat
+
+import pytest
+
+from sync import MediaSync, fast_copy
+
+
+@pytest.mark.parametrize("mode", [0o644, 0o755])
+def test_fast_copy_keeps_the_source_mode(tmp_path, mode):
+    source = tmp_path / "font.woff2"
+    source.write_bytes(b"wOF2")
+    source.chmod(mode)
+    destination = tmp_path / "build" / "font.woff2"
+
+    fast_copy(str(source), str(destination))
+
+    assert destination.read_bytes() == b"wOF2"
+    assert stat.S_IMODE(os.stat(destination).st_mode) == mode
+
+
+def test_settings_change_prunes_previous_outputs(tmp_path):
+    media, build = tmp_path / "media", tmp_path / "build"
+    media.mkdir()
+    (media / "photo.jpg").write_bytes(b"jpeg")
+    (media / "gone.jpg").write_bytes(b"jpeg")
+
+    sync = MediaSync(str(media), str(build / "media"), str(tmp_path), settings={"widths": [200]})
+    for destination in sync.sync():
+        variant = destination.replace(".jpg", "-200w.webp")
+        open(variant, "wb").close()
+        sync.record_outputs(destination, [variant])
+    sync.save()
+
+    (media / "gone.jpg").unlink()
+    sync = MediaSync(str(media), str(build / "media"), str(tmp_path), settings={"widths": [300]})
+    for destination in sync.sync():
+        sync.record_outputs(destination, [])
+    sync.save()
+
+    assert sorted(os.listdir(build / "media")) == ["photo.jpg"]
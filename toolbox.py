@@ -1,11 +1,19 @@
+import functools
 import hashlib
+import os
 import random
-import yaml
 import unicodedata
 import re
 from loguru import logger
 import json
 import plugin
+import profiling
+from markupsafe import escape
+from data_loader import DataLoader, freeze
+from fingerprint import AssetManifest, fingerprintable
+from incremental import record_dependency
+from media_index import MediaIndex
+from responsive import MIME_TYPES, VariantManifest
 
 class Tokens:
     def __init__(self):
@@ -19,6 +27,38 @@ class Tokens:
 
 
 _TOKENS = Tokens()
+_DATA = DataLoader("src")
+
+
+def _attributes(attrs):
+    return "".join(f' {name.replace("_", "-")}="{escape(value)}"' for name, value in attrs.items())
+
+
+class PluginHandle:
+    """
+    Forwards to a plugin instance, created on first attribute access, recording
+    its use as a build dependency.
+    """
+
+    def __init__(self, namespace, factory):
+        self._namespace = namespace
+        self._factory = factory
+        self._instance = None
+
+    def __getattr__(self, name):
+        record_dependency("plugin", self._namespace)
+        if self._instance is None:
+            self._instance = self._factory()
+        value = getattr(self._instance, name)
+        if not profiling.enabled() or not callable(value):
+            return value
+
+        @functools.wraps(value)
+        def timed(*args, **kwargs):
+            with profiling.span(f"{self._namespace}.{name}", "plugin"):
+                return value(*args, **kwargs)
+
+        return timed
 
 
 class Toolbox:
@@ -28,10 +68,26 @@ class Toolbox:
 
     @staticmethod
     def load_yaml(path):
-        path = "src/" + path
-        with open(path) as f:
-            data = yaml.safe_load(f)
-            return data
+        record_dependency("data", path)
+        with profiling.span("load_yaml", "data", path=path):
+            return _DATA.load_yaml(path)
+
+    @staticmethod
+    def load_json(path):
+        record_dependency("data", path)
+        with profiling.span("load_json", "data", path=path):
+            return _DATA.load_json(path)
+
+    @staticmethod
+    def load_csv(path, delimiter=","):
+        record_dependency("data", path)
+        with profiling.span("load_csv", "data", path=path):
+            return _DATA.load_csv(path, delimiter)
+
+    @staticmethod
+    def iter_items(path, delimiter=","):
+        record_dependency("data", path)
+        return _DATA.iter_items(path, delimiter)
 
     @staticmethod
     def get_dot_path(data, dot_path):
@@ -64,7 +120,8 @@ class Toolbox:
 
     @staticmethod
     def hash(text, length=None):
-        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        data = text.encode("utf-8") if isinstance(text, str) else text
+        digest = hashlib.sha256(data).hexdigest()
         return digest if length is None else digest[:length]
 
     @staticmethod
@@ -78,12 +135,92 @@ class Toolbox:
         p = {"type": "end_page"}
         return _TOKENS.bake(p)
     
-    def __init__(self):
+    def asset(self, path):
+        """
+        URL of build file `path` under its fingerprinted name when the build
+        fingerprints assets (`--fingerprint`), `path` itself otherwise.
+        """
+        relative_path = path.lstrip("/")
+        if not self.fingerprint or not fingerprintable(relative_path):
+            return path
+
+        if os.path.exists(os.path.join(self.src_folder, relative_path)):
+            record_dependency("src", relative_path)
+        else:
+            record_dependency("build", relative_path)
+        if self._assets is None:
+            self._assets = AssetManifest.load(self.build_folder)
+        try:
+            return path[:len(path) - len(relative_path)] + self._assets.resolve(relative_path)
+        except FileNotFoundError:
+            logger.warning(f"Asset {relative_path} not found in {self.build_folder}")
+            return path
+
+    def media_info(self, path):
+        """
+        Metadata of media file `path` (width, height, format, size, color,
+        hash) from the index the media stage keeps, None if it isn't indexed.
+        """
+        record_dependency("build", f"{self.media_folder}/{MediaIndex.filename}")
+        index_path = os.path.join(self.build_folder, self.media_folder, MediaIndex.filename)
+        mtime = os.path.getmtime(index_path) if os.path.exists(index_path) else None
+        if mtime != self._media_index_mtime:
+            self._media_index = freeze(MediaIndex.load(os.path.join(self.build_folder, self.media_folder)).files)
+            self._media_index_mtime = mtime
+        return self._media_index.get(path)
+
+    def picture(self, path, alt="", sizes="100vw", **attrs):
+        """
+        <picture> markup for media file `path` with a srcset per variant format,
+        falling back to a plain <img> when the image has no variants.
+        """
+        record_dependency("build", f"{self.media_folder}/{VariantManifest.filename}")
+        manifest_path = os.path.join(self.build_folder, self.media_folder, VariantManifest.filename)
+        mtime = os.path.getmtime(manifest_path) if os.path.exists(manifest_path) else None
+        if mtime != self._variants_mtime:
+            self._variants = VariantManifest.load(os.path.join(self.build_folder, self.media_folder)).images
+            self._variants_mtime = mtime
+
+        image = self._variants.get(path)
+        img_attrs = {"src": self.asset(f"{self.media_folder}/{path}"), "alt": alt, **attrs}
+        if image is None:
+            info = self.media_info(path)
+            if info and info["width"]:
+                img_attrs = {**img_attrs, "width": info["width"], "height": info["height"]}
+            return f"<img{_attributes(img_attrs)}>"
+
+        img_attrs = {**img_attrs, "width": image["width"], "height": image["height"]}
+        img_attrs.setdefault("loading", "lazy")
+        lines = ["<picture>"]
+        for fmt in sorted(image["variants"], key=lambda f: list(MIME_TYPES).index(f)):
+            srcset = ", ".join(
+                f"{self.asset(f'{self.media_folder}/{name}')} {width}w" for width, name in image["variants"][fmt]
+            )
+            lines.append(f"<source{_attributes({'type': MIME_TYPES[fmt], 'srcset': srcset, 'sizes': sizes})}>")
+        lines.append(f"<img{_attributes(img_attrs)}>")
+        lines.append("</picture>")
+        return "\n".join(lines)
+
+    def __init__(self, build_folder="build", media_folder="media", src_folder="src", fingerprint=False):
+        global _DATA
+        if _DATA.folder != src_folder:
+            _DATA = DataLoader(src_folder)
+        self.build_folder = build_folder
+        self.media_folder = media_folder
+        self.src_folder = src_folder
+        self.fingerprint = fingerprint
+        self._assets = None
+        self._variants = {}
+        self._variants_mtime = None
+        self._media_index = {}
+        self._media_index_mtime = None
         self.plugins = {}
 
-        for cls in plugin.Plugin.__subclasses__():
-            ns = getattr(cls, "namespace", None)
-            if ns:
-                inst = cls()
-                self.plugins[ns] = inst
-                setattr(self, ns, inst)
+    def __getattr__(self, name):
+        # Plugins are looked up (and entry points scanned) the first time a template uses one
+        factory = None if name.startswith("_") else plugin.registry().get(name)
+        if factory is None:
+            raise AttributeError(name)
+        handle = self.plugins[name] = PluginHandle(name, factory)
+        setattr(self, name, handle)
+        return handle
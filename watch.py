@@ -0,0 +1,73 @@
+import os
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from loguru import logger
+
+
+def snapshot(folder):
+    """Map every file under folder to its (mtime, size)."""
+    files = {}
+    for root, _, names in os.walk(folder):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files[path] = (st.st_mtime_ns, st.st_size)
+    return files
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+
+def serve(folder, host, port):
+    handler = partial(QuietHandler, directory=folder)
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Serving {folder} on http://{host}:{port}/")
+    return server
+
+
+def watch(jinjapocalypse, host="127.0.0.1", port=8000, interval=0.2):
+    """
+    Poll src/ and media/ and rebuild on change, reusing the warm instance so
+    that only the outputs affected by a change are rendered again.
+    """
+    server = serve(jinjapocalypse.build_folder, host, port)
+    src = snapshot(jinjapocalypse.src_folder)
+    media = snapshot(jinjapocalypse.media_folder)
+    logger.info(f"Watching {jinjapocalypse.src_folder} and {jinjapocalypse.media_folder}, Ctrl+C to stop")
+
+    try:
+        while True:
+            time.sleep(interval)
+
+            current = snapshot(jinjapocalypse.src_folder)
+            if current != src:
+                src = current
+                started = time.monotonic()
+                try:
+                    jinjapocalypse.render_files()
+                    logger.info(f"Rebuilt in {time.monotonic() - started:.3f}s")
+                except Exception as e:
+                    logger.exception(f"Rebuild failed: {e}")
+
+            current = snapshot(jinjapocalypse.media_folder)
+            if current != media:
+                media = current
+                try:
+                    jinjapocalypse.process_media()
+                    # Pages reading media metadata are dirty now
+                    jinjapocalypse.render_files()
+                except Exception as e:
+                    logger.exception(f"Media rebuild failed: {e}")
+    except KeyboardInterrupt:
+        logger.info("Stopped watching")
+    finally:
+        server.shutdown()